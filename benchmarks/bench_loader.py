@@ -0,0 +1,72 @@
+"""DataLoader throughput probe: samples/sec of voc_seg/voc_cls per loader setting.
+
+    python benchmarks/bench_loader.py --root seg_da/VOCdevkit/VOC2010 --workers 0 4 8 --prefetch 2 4
+
+The first batch of every setting (worker start-up) is timed separately from
+the steady-state rate.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+import common
+
+
+def probe(loader, batches):
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    first = time.perf_counter() - start
+
+    seen = 0
+    start = time.perf_counter()
+    for batch in itertools.islice(iterator, batches):
+        seen += batch[0].size(0)
+    elapsed = time.perf_counter() - start
+    return first, seen / elapsed if elapsed > 0 else float("nan")
+
+
+def main():
+    import torch
+    import dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default="seg_da/VOCdevkit/VOC2010", type=str)
+    parser.add_argument("--mode", default="segmentation", type=str)
+    parser.add_argument("--cache-dir", default=None, type=str)
+    parser.add_argument("--cut-out", action="store_true")
+    parser.add_argument("--batch", default=8, type=int)
+    parser.add_argument("--batches", default=20, type=int, help="Batches timed per setting after the first")
+    parser.add_argument("--workers", default=[0, 2, 4], type=int, nargs="+")
+    parser.add_argument("--prefetch", default=[2], type=int, nargs="+")
+    parser.add_argument("--pin-memory", action="store_true")
+    parser.add_argument("--output", default=None, type=str, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    label_path = os.path.join(args.root, "SegmentationClass")
+    image_path = os.path.join(args.root, "JPEGImages")
+    if args.mode == "segmentation":
+        data = dataset.voc_seg(label_path, image_path, cut_out=args.cut_out, cache_dir=args.cache_dir)
+    else:
+        data = dataset.voc_cls(label_path, image_path, cut_out=args.cut_out, cache_dir=args.cache_dir)
+    sampler = torch.utils.data.RandomSampler(data, replacement=True, num_samples=args.batch * (args.batches + 1))
+
+    rows = []
+    for workers in args.workers:
+        for prefetch in (args.prefetch if workers > 0 else [None]):
+            loader = dataset.build_loader(data, args.batch, sampler, workers=workers, prefetch_factor=prefetch,
+                                          pin_memory=args.pin_memory)
+            first, rate = probe(loader, args.batches)
+            rows.append(dict(workers=workers, prefetch=prefetch, pin_memory=args.pin_memory,
+                             first_batch_sec=first, samples_per_sec=rate))
+
+    common.print_table(rows, ["workers", "prefetch", "pin_memory", "first_batch_sec", "samples_per_sec"])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
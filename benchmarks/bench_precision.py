@@ -0,0 +1,94 @@
+"""fp32 vs bfloat16 autocast: images/sec and peak RSS of Unet2D and ResNet-50 on CPU.
+
+    python benchmarks/bench_precision.py --batch 8 --steps 5 --threads 16
+
+Every (model, precision, phase) combination runs in its own process so the
+reported peak RSS belongs to that configuration alone.
+"""
+import argparse
+import json
+import os
+import sys
+
+import common
+
+
+def worker(model_name, precision, phase, batch, size, steps, threads):
+    import torch
+    import torch.nn as nn
+    import torchvision
+    from unet import Unet2D
+    from optimizers import RAdam
+
+    torch.manual_seed(0)
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+    if model_name == "unet":
+        net = Unet2D((3, size, size), 1, 0.1, num_classes=21)
+        target = torch.randint(0, 21, (batch, size, size))
+        criterion = nn.CrossEntropyLoss()
+    else:
+        net = torchvision.models.resnet50(num_classes=20)
+        target = (torch.rand(batch, 20) > 0.8).float()
+        criterion = nn.BCEWithLogitsLoss()
+    x = torch.randn(batch, 3, size, size)
+    optimizer = RAdam(net.parameters(), lr=0.0001)
+    enabled = precision == "bf16"
+
+    def train_step():
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=enabled):
+            loss = criterion(net(x), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    def infer_step():
+        with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=enabled):
+            net(x)
+
+    if phase == "train":
+        net.train()
+        seconds = common.timed(train_step, steps)
+    else:
+        net.eval()
+        seconds = common.timed(infer_step, steps)
+
+    return dict(model=model_name, precision=precision, phase=phase, batch=batch,
+                images_per_sec=batch / seconds, peak_rss_mb=common.peak_rss_mb())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", default=["unet", "resnet50"], nargs="+")
+    parser.add_argument("--phases", default=["train", "infer"], nargs="+")
+    parser.add_argument("--batch", default=8, type=int)
+    parser.add_argument("--size", default=256, type=int)
+    parser.add_argument("--steps", default=5, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="torch threads, 0 keeps the default")
+    parser.add_argument("--output", default=None, type=str, help="Write the results as JSON")
+    parser.add_argument("--worker", default=None, nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(worker(*args.worker, batch=args.batch, size=args.size, steps=args.steps, threads=args.threads)))
+        return
+
+    rows = []
+    for model_name in args.models:
+        for phase in args.phases:
+            for precision in ("fp32", "bf16"):
+                rows.append(common.run_isolated(os.path.abspath(__file__), [
+                    "--worker", model_name, precision, phase, "--batch", args.batch,
+                    "--size", args.size, "--steps", args.steps, "--threads", args.threads]))
+            fp32, bf16 = rows[-2], rows[-1]
+            bf16["speedup"] = bf16["images_per_sec"] / fp32["images_per_sec"]
+
+    common.print_table(rows, ["model", "phase", "precision", "batch", "images_per_sec", "peak_rss_mb", "speedup"])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
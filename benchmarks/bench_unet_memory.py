@@ -0,0 +1,75 @@
+"""Unet2D activation checkpointing: peak RSS vs training throughput across batch sizes on CPU.
+
+    python benchmarks/bench_unet_memory.py --batches 2 4 8 --steps 3 --threads 16
+
+Every (checkpoint mode, batch size) combination runs in its own process so the
+reported peak RSS belongs to that configuration alone.
+"""
+import argparse
+import json
+import os
+
+import common
+
+
+def worker(mode, batch, size, steps, threads):
+    import torch
+    import torch.nn as nn
+    from unet import Unet2D
+    from optimizers import RAdam
+
+    torch.manual_seed(0)
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+    net = Unet2D((3, size, size), 1, 0.1, num_classes=21, checkpoint=mode)
+    net.train()
+    x = torch.randn(batch, 3, size, size)
+    target = torch.randint(0, 21, (batch, size, size))
+    criterion = nn.CrossEntropyLoss()
+    optimizer = RAdam(net.parameters(), lr=0.0001)
+
+    def train_step():
+        loss = criterion(net(x), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    seconds = common.timed(train_step, steps)
+    return dict(checkpoint=mode, batch=batch, images_per_sec=batch / seconds, peak_rss_mb=common.peak_rss_mb())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default=["none", "center", "all"], nargs="+")
+    parser.add_argument("--batches", default=[2, 4, 8], type=int, nargs="+")
+    parser.add_argument("--size", default=256, type=int)
+    parser.add_argument("--steps", default=3, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="torch threads, 0 keeps the default")
+    parser.add_argument("--output", default=None, type=str, help="Write the results as JSON")
+    parser.add_argument("--worker", default=None, nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        mode, batch = args.worker
+        print(json.dumps(worker(mode, int(batch), size=args.size, steps=args.steps, threads=args.threads)))
+        return
+
+    rows = []
+    for batch in args.batches:
+        for mode in args.modes:
+            rows.append(common.run_isolated(os.path.abspath(__file__), [
+                "--worker", mode, batch, "--size", args.size, "--steps", args.steps, "--threads", args.threads]))
+        base = rows[-len(args.modes)]
+        for row in rows[-len(args.modes):]:
+            row["memory_saved"] = 1. - row["peak_rss_mb"] / base["peak_rss_mb"]
+            row["relative_speed"] = row["images_per_sec"] / base["images_per_sec"]
+
+    common.print_table(rows, ["batch", "checkpoint", "images_per_sec", "peak_rss_mb", "memory_saved", "relative_speed"])
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+# benchmarks import the repo modules the same flat way main.py does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, "models"), os.path.join(ROOT, "utils"), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (ru_maxrss is KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def timed(fn, steps, warmup=1):
+    """Mean wall-clock seconds per call of fn over `steps` calls after `warmup` calls."""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+def run_isolated(script, argv):
+    """
+      Runs `script` with `argv` in a fresh interpreter and returns the JSON
+      object it prints last, so peak RSS is measured per configuration.
+      """
+    out = subprocess.check_output([sys.executable, script] + [str(a) for a in argv])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def print_table(rows, columns):
+    widths = [max(len(c), max(len(_fmt(r.get(c))) for r in rows)) for c in columns]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(_fmt(r.get(c)).rjust(w) for c, w in zip(columns, widths)))
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:.2f}".format(value)
+    return str(value)
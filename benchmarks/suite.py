@@ -0,0 +1,237 @@
+"""CPU regression benchmark suite: models, losses, optimizers, attacks and dataset access.
+
+    python benchmarks/suite.py --output bench.json                     # run and record
+    python benchmarks/suite.py --baseline bench.json --threshold 0.15  # compare, exit 1 on regressions
+    python benchmarks/suite.py --quick --only unet optim               # small sizes, a subset of groups
+
+Every case is timed as the median over --repeats runs of the mean seconds per
+call (with enough calls per run to span --min-time), with fixed seeds and a fixed torch thread count, so numbers recorded on
+one machine are comparable across commits. Results are JSON: a "meta" block
+describing the machine and a "results" map of case name -> seconds.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+
+import common
+
+GROUPS = ("unet", "resnet", "loss", "optim", "attack", "dataset")
+RESNETS = ("resnet18", "resnet34", "resnet50", "resnet101", "resnet152",
+           "resnext50_32x4d", "resnext101_32x8d", "wide_resnet50_2", "wide_resnet101_2")
+
+
+def unet_cases(args):
+    import torch
+    import torch.nn as nn
+    from unet import Unet2D
+
+    size = 64 if args.quick else 256
+    for threads in args.threads:
+        for batch in args.batches:
+            def case(batch=batch):
+                torch.manual_seed(0)
+                net = Unet2D((3, size, size), 1, 0.1, num_classes=21)
+                x = torch.randn(batch, 3, size, size)
+                y = torch.randint(0, 21, (batch, size, size))
+                criterion = nn.CrossEntropyLoss()
+
+                def step():
+                    net.zero_grad()
+                    criterion(net(x), y).backward()
+                return step
+            yield "unet/fwd-bwd/s{}/b{}/t{}".format(size, batch, threads), threads, case
+
+
+def resnet_cases(args):
+    import torch
+    import torch.nn as nn
+    import resnet
+
+    size = 64 if args.quick else 224
+    names = RESNETS[:2] if args.quick else RESNETS
+    for name in names:
+        def case(name=name):
+            torch.manual_seed(0)
+            net = getattr(resnet, name)(num_classes=20)
+            x = torch.randn(args.batches[0], 3, size, size)
+            y = (torch.rand(args.batches[0], 20) > 0.8).float()
+            criterion = nn.BCEWithLogitsLoss()
+
+            def step():
+                net.zero_grad()
+                criterion(net(x), y).backward()
+            return step
+        yield "resnet/{}/fwd-bwd/s{}/b{}".format(name, size, args.batches[0]), args.threads[0], case
+
+
+def loss_cases(args):
+    import torch
+    import torch.nn as nn
+    import torch.nn.functional as F
+    from losses import DiceLoss, SmoothCrossEntropyLoss
+
+    size = 64 if args.quick else 256
+    batch = args.batches[0]
+
+    def inputs():
+        torch.manual_seed(0)
+        logits = torch.randn(batch, 21, size, size, requires_grad=True)
+        target = torch.randint(0, 21, (batch, size, size))
+        return logits, target
+
+    def cross_entropy():
+        logits, target = inputs()
+        criterion = nn.CrossEntropyLoss()
+        return lambda: criterion(logits, target).backward()
+
+    def smooth_cross_entropy():
+        logits, target = inputs()
+        criterion = SmoothCrossEntropyLoss(smoothing=0.1)
+        # the loss works on (N, C) rows, so pixels become rows
+        return lambda: criterion(logits.permute(0, 2, 3, 1).reshape(-1, 21), target.reshape(-1)).backward()
+
+    def dice():
+        logits, target = inputs()
+        one_hot = F.one_hot(target, 21).permute(0, 3, 1, 2).float()
+        criterion = DiceLoss()
+        return lambda: criterion(logits, one_hot).backward()
+
+    for name, case in (("cross_entropy", cross_entropy), ("smooth_cross_entropy", smooth_cross_entropy), ("dice", dice)):
+        yield "loss/{}/s{}/b{}".format(name, size, batch), args.threads[0], case
+
+
+def optim_cases(args):
+    import torch
+    from unet import Unet2D
+    from optimizers import RAdam, AdamW
+
+    def build(cls, **kwargs):
+        def case():
+            torch.manual_seed(0)
+            # Unet2D's parameter set: 31M parameters in 82 tensors of very different sizes
+            params = [p.detach().clone().requires_grad_(True) for p in Unet2D((3, 64, 64), 1, 0.1, num_classes=21).parameters()]
+            for p in params:
+                p.grad = torch.randn_like(p)
+            optimizer = cls(params, lr=1e-4, **kwargs)
+            return optimizer.step
+        return case
+
+    yield "optim/radam", args.threads[0], build(RAdam)
+    yield "optim/radam-foreach", args.threads[0], build(RAdam, foreach=True)
+    yield "optim/adamw", args.threads[0], build(AdamW)
+    yield "optim/adamw-foreach", args.threads[0], build(AdamW, foreach=True)
+
+
+def attack_cases(args):
+    import numpy as np
+    import torch
+    from utils import optimize_linear
+
+    size = 64 if args.quick else 256
+    for label, norm in (("inf", np.inf), ("l1", 1), ("l2", 2)):
+        def case(norm=norm):
+            torch.manual_seed(0)
+            grad = torch.randn(args.batches[0], 3, size, size)
+            return lambda: optimize_linear(grad, 0.25, norm)
+        yield "attack/optimize_linear/{}/s{}/b{}".format(label, size, args.batches[0]), args.threads[0], case
+
+
+def dataset_cases(args):
+    import dataset
+
+    label_path = os.path.join(args.root, "SegmentationClass")
+    image_path = os.path.join(args.root, "JPEGImages")
+    if not os.path.isdir(label_path):
+        return
+    variants = [("voc_seg", dataset.voc_seg, None), ("voc_cls", dataset.voc_cls, None)]
+    if args.cache_dir is not None:
+        variants += [("voc_seg-cache", dataset.voc_seg, args.cache_dir), ("voc_cls-cache", dataset.voc_cls, args.cache_dir)]
+    for name, cls, cache_dir in variants:
+        def case(cls=cls, cache_dir=cache_dir):
+            data = cls(label_path, image_path, cache_dir=cache_dir)
+            index = [0]
+
+            def get():
+                data[index[0] % len(data)]
+                index[0] += 1
+            return get
+        yield "dataset/{}/getitem".format(name), 1, case
+
+
+def run_case(threads, case, steps, repeats, min_time):
+    import torch
+    torch.set_num_threads(threads)
+    fn = case()
+    # micro cases get more calls per timing, so every timing spans at least min_time
+    once = common.timed(fn, 1)
+    steps = max(steps, int(math.ceil(min_time / max(once, 1e-9))))
+    return statistics.median(common.timed(fn, steps, warmup=0) for _ in range(repeats))
+
+
+def _seconds(value):
+    # micro cases run in microseconds, print_table's two decimals would hide them
+    return None if value is None else "{:.5f}".format(value)
+
+
+def compare(results, baseline, threshold):
+    rows, regressions = [], []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        ratio = seconds / base if base else None
+        status = "-" if ratio is None else ("REGRESSION" if ratio > 1 + threshold else ("faster" if ratio < 1 - threshold else "ok"))
+        if status == "REGRESSION":
+            regressions.append(name)
+        rows.append(dict(case=name, seconds=_seconds(seconds), baseline=_seconds(base), ratio=ratio, status=status))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default=list(GROUPS), nargs="+", help="Groups to run: " + ", ".join(GROUPS))
+    parser.add_argument("--batches", default=[2, 4], type=int, nargs="+", help="Unet2D batch sizes; the first is used elsewhere")
+    parser.add_argument("--threads", default=[1, 4], type=int, nargs="+", help="Unet2D thread counts; the first is used elsewhere")
+    parser.add_argument("--steps", default=3, type=int, help="Calls per timing")
+    parser.add_argument("--repeats", default=3, type=int, help="Timings per case, the median is reported")
+    parser.add_argument("--min-time", default=0.2, type=float, help="Minimum seconds per timing; fast cases are called more often")
+    parser.add_argument("--quick", action="store_true", help="Small inputs and a reduced ResNet list, for smoke checks")
+    parser.add_argument("--root", default="seg_da/VOCdevkit/VOC2010", type=str, help="VOC root for the dataset cases")
+    parser.add_argument("--cache-dir", default=None, type=str, help="Also time the cached datasets")
+    parser.add_argument("--output", default=None, type=str, help="Write the results as JSON")
+    parser.add_argument("--baseline", default=None, type=str, help="Results JSON to compare against")
+    parser.add_argument("--threshold", default=0.1, type=float, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    import torch
+    generators = dict(unet=unet_cases, resnet=resnet_cases, loss=loss_cases, optim=optim_cases,
+                      attack=attack_cases, dataset=dataset_cases)
+    results = {}
+    for group in args.only:
+        for name, threads, case in generators[group](args):
+            results[name] = run_case(threads, case, args.steps, args.repeats, args.min_time)
+            print(" [Bench] {} {:.4f}s".format(name, results[name]), flush=True)
+
+    report = dict(meta=dict(torch=torch.__version__, python=platform.python_version(), machine=platform.machine(),
+                            processor=platform.processor(), cpus=os.cpu_count(), quick=args.quick),
+                  results=results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is None:
+        common.print_table([dict(case=k, seconds=_seconds(v)) for k, v in results.items()], ["case", "seconds"])
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows, regressions = compare(results, baseline["results"], args.threshold)
+    common.print_table(rows, ["case", "seconds", "baseline", "ratio", "status"])
+    if regressions:
+        print(" [Bench] {} regression(s) over {:.0%}: {}".format(len(regressions), args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
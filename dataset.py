@@ -1,6 +1,10 @@
 # import some packages you need here
 import torch
+import torch.nn.functional as F
 import os
+import json
+import shutil
+import random
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
 import string 
@@ -12,7 +16,8 @@ object_categories = ['aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'c
                         'dog', 'horse', 'motorbike', 'person', 'pottedplant', 'sheep', 'sofa', 'train', 'tvmonitor']
 
 class voc_cls(Dataset):
-    def __init__(self, label_path, image_path, cut_out=False, smooth=False) :
+    def __init__(self, label_path, image_path, cut_out=False, smooth=False, cache_dir=None, label_index=None, normalize=True,
+                 imagesets_path=None) :
         self.label_path = label_path
         self.image_path = image_path
         self.classes = ['aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'car', 'cat', 'chair', 'cow', 'diningtable', 
@@ -24,6 +29,21 @@ class voc_cls(Dataset):
         self.smooth = smooth 
         self.normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.cut_out = cut_out
+        self.cutout = cutout(mask_size = 32, p = 0.5, cutout_inside = True)
+        # normalize=False returns uint8 CHW images and leaves cutout/normalization
+        # to batch_augment after collation
+        self.raw = not normalize
+        self.cache = None
+        if cache_dir is not None :
+            self.cache = open_cache(cache_dir, label_path, image_path, self.resize)
+            self.data_list = self.cache.data_list
+        if label_index is None :
+            label_index = default_label_index(label_path, cache_dir, imagesets_path)
+
+        # multi-hot targets are looked up from per-image class bitmasks, so no
+        # label PNG is decoded in __getitem__
+        masks = open_label_index(label_index, label_path, self.data_list, self.resize, self.cache, imagesets_path)
+        self.targets = torch.from_numpy(bitmask_to_multi_hot(masks, len(self.classes)))
     
     def __len__(self) :
         return len(self.data_list)
@@ -31,30 +51,22 @@ class voc_cls(Dataset):
     def __getitem__(self, idx) :
 
         base = self.data_list[idx]
-        label = os.path.join(self.label_path, base)
-        image = os.path.join(self.image_path, base.replace(".png", ".jpg"))
         file_name = os.path.join(self.image_path, base.replace(".png", ".jpg"))
 
-        image = Image.open(image)
-        image = self.resize(image)
-        if self.cut_out == True :
-            ct = cutout(mask_size = 32, p = 0.5, cutout_inside = True)
-            image = ct(image)
-        image = self.transform_1(image)
-        image = self.normalize(image)
-
-        label = Image.open(label)
-        label = self.resize(label)
-        label = np.array(label)
-        label[label == 255] = 0
-        uni = np.unique(label)
-        
-        case = torch.zeros(20)
-        for i in uni :
-            if i == 0 :
-                pass
-            else :
-                case[i-1] = 1
+        if self.cache is not None :
+            image = self.cache.image(idx)
+        else :
+            image = load_image(self.image_path, base, self.resize)
+
+        if self.raw :
+            image = torch.from_numpy(image.transpose(2, 0, 1))
+        else :
+            if self.cut_out == True :
+                image = self.cutout(image)
+            image = self.transform_1(image)
+            image = self.normalize(image)
+
+        case = self.targets[idx]
         
         non_smooth = case 
         
@@ -68,7 +80,7 @@ class voc_cls(Dataset):
         return self.classes
 
 class voc_seg(Dataset):
-    def __init__(self, label_path, image_path, cut_out=False, smooth=False) :
+    def __init__(self, label_path, image_path, cut_out=False, smooth=False, cache_dir=None, normalize=True) :
         self.label_path = label_path
         self.image_path = image_path
         self.classes = ["background", 'aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'car', 'cat', 'chair', 'cow', 'diningtable', 
@@ -80,6 +92,12 @@ class voc_seg(Dataset):
         self.transform_1 = transforms.ToTensor()
         self.resize = transforms.Resize((256, 256))
         self.normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        self.cutout = cutout(mask_size = 32, p = 0.5, cutout_inside = True)
+        self.raw = not normalize
+        self.cache = None
+        if cache_dir is not None :
+            self.cache = open_cache(cache_dir, label_path, image_path, self.resize)
+            self.data_list = self.cache.data_list
     
     def __len__(self) :
         return len(self.data_list)
@@ -87,25 +105,20 @@ class voc_seg(Dataset):
     def __getitem__(self, idx) :
 
         base = self.data_list[idx]
-        label = os.path.join(self.label_path, base)
-        image = os.path.join(self.image_path, base.replace(".png", ".jpg"))
         file_name = os.path.join(self.image_path, base.replace(".png", ".jpg"))
 
-        image = Image.open(image)
-        image = self.resize(image)
-
-        if self.cut_out == True :
-            cut = cutout(mask_size = 32, p = 0.5, cutout_inside = True)
-            image = cut(image)
-
-        image = self.transform_1(image)
-        image = self.normalize(image)
+        if self.cache is not None :
+            image, label = self.cache[idx]
+        else :
+            image, label = load_resized(self.label_path, self.image_path, base, self.resize)
 
-        label = Image.open(label)
-        label = self.resize(label)
-        label = np.array(label)
-
-        label[label == 255] = 0
+        if self.raw :
+            image = torch.from_numpy(image.transpose(2, 0, 1))
+        else :
+            if self.cut_out == True :
+                image = self.cutout(image)
+            image = self.transform_1(image)
+            image = self.normalize(image)
 
         non_smooth = label 
 
@@ -113,25 +126,349 @@ class voc_seg(Dataset):
             label = label - 0.01
             label = np.abs(label)
 
-        label = torch.tensor(label)
+        label = torch.from_numpy(label)
 
         return image, label, file_name, non_smooth
     
     def get_classes(self) :
         return self.classes
 
-def cutout(mask_size, p, cutout_inside, mask_color=(0, 0, 0)):
-    mask_size_half = mask_size // 2
-    offset = 1 if mask_size % 2 == 0 else 0
-    
-    def _cutout(image):
+def load_image(image_path, base, resize) :
+    # resized RGB image (HWC uint8) for the label file `base`
+    image = Image.open(os.path.join(image_path, base.replace(".png", ".jpg")))
+    if image.mode != "RGB" :
+        image = image.convert("RGB")
+    return np.array(resize(image))
+
+def load_label(label_path, base, resize) :
+    # resized label map with the 255 boundary class folded into background
+    label = np.array(resize(Image.open(os.path.join(label_path, base))))
+    label[label == 255] = 0
+    return label
+
+def load_resized(label_path, image_path, base, resize) :
+    return load_image(image_path, base, resize), load_label(label_path, base, resize)
+
+def build_label_index(label_path, data_list, resize=None, cache=None, imagesets_path=None, rows=None) :
+    """Class bitmask per image: bit i is set when object_categories[i] is present.
+
+    By default the masks are read from the (resized) SegmentationClass PNGs, or
+    from the already decoded label maps when a `voc_cache` is given, so they match
+    what voc_cls used to compute per sample. With `imagesets_path` pointing at
+    ImageSets/Main they are read from the per-class trainval lists instead
+    (difficult objects, flagged 0, count as present); images missing from those
+    lists (e.g. every 2007_* image of VOC2010) still fall back to their PNGs.
+    `rows` are the cache rows of data_list when it is a subset of the cache.
+    """
+    masks = np.zeros(len(data_list), dtype=np.uint32)
+    seen = np.zeros(len(data_list), dtype=bool)
+
+    if imagesets_path is not None :
+        row = dict((base.replace(".png", ""), i) for i, base in enumerate(data_list))
+        for c, name in enumerate(object_categories) :
+            with open(os.path.join(imagesets_path, "{}_trainval.txt".format(name))) as f :
+                for line in f :
+                    stem, flag = line.split()
+                    if stem in row :
+                        seen[row[stem]] = True
+                        if int(flag) >= 0 :
+                            masks[row[stem]] |= np.uint32(1 << c)
+
+    if resize is None :
+        resize = transforms.Resize((256, 256))
+    for i in np.flatnonzero(~seen) :
+        base = data_list[i]
+        label = cache.label(i if rows is None else rows[i]) if cache is not None else load_label(label_path, base, resize)
+        for c in np.unique(label) :
+            if c != 0 :
+                masks[i] |= np.uint32(1 << (int(c) - 1))
+    return masks
+
+def save_label_index(path, lookup) :
+    stems = np.array(sorted(lookup))
+    masks = np.array([lookup[stem] for stem in stems], dtype=np.uint32)
+    tmp_path = path + ".tmp-{}.npz".format(os.getpid())
+    np.savez(tmp_path, stems=stems, masks=masks)
+    os.replace(tmp_path, path)
+
+def load_label_index(path) :
+    # stem -> class bitmask
+    with np.load(path) as index :
+        return dict(zip(index["stems"].tolist(), index["masks"].tolist()))
+
+def default_label_index(label_path, cache_dir=None, imagesets_path=None) :
+    # next to the cache, or else next to SegmentationClass, so every run (and
+    # every sweep job) reuses one index; PNG and ImageSets labels differ
+    name = "label_index.npz" if imagesets_path is None else "label_index-imagesets.npz"
+    if cache_dir is not None :
+        return os.path.join(cache_dir, name)
+    return os.path.join(os.path.dirname(os.path.normpath(label_path)), name)
+
+def open_label_index(path, label_path, data_list, resize=None, cache=None, imagesets_path=None) :
+    # build the index once and persist it when a path is given; images added
+    # since it was saved are indexed and merged in
+    lookup = {}
+    if path is not None and os.path.exists(path) :
+        lookup = load_label_index(path)
+    stems = [base.replace(".png", "") for base in data_list]
+    missing = [i for i, stem in enumerate(stems) if stem not in lookup]
+    if missing :
+        masks = build_label_index(label_path, [data_list[i] for i in missing], resize, cache, imagesets_path, rows=missing)
+        lookup.update((stems[i], int(mask)) for i, mask in zip(missing, masks))
+        if path is not None :
+            try :
+                save_label_index(path, lookup)
+            except OSError as e :
+                # a read-only dataset directory only costs the rebuild next time
+                print(" [Dataset] label index not saved to {}: {}".format(path, e))
+    return np.array([lookup[stem] for stem in stems], dtype=np.uint32)
+
+def bitmask_to_multi_hot(masks, num_classes) :
+    bits = np.arange(num_classes, dtype=np.uint32)
+    return ((masks[:, None] >> bits) & 1).astype(np.float32)
+
+class voc_cache(object):
+    """Memory-mapped view of a directory written by `compile_cache`.
+
+    images.npy holds uint8 NCHW images, labels.npy uint8 NHW label maps and
+    index.txt the label file names in row order. Arrays are opened lazily so
+    every DataLoader worker maps the files itself instead of pickling them.
+    """
+    def __init__(self, cache_dir) :
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "index.txt")) as f :
+            self.data_list = f.read().split()
+        self.images = None
+        self.labels = None
+
+    def __len__(self) :
+        return len(self.data_list)
+
+    def _open(self) :
+        if self.images is None :
+            # copy-on-write mapping: views are writable for torch.from_numpy,
+            # but nothing is ever written back to the cache files
+            self.images = np.load(os.path.join(self.cache_dir, "images.npy"), mmap_mode="c")
+            self.labels = np.load(os.path.join(self.cache_dir, "labels.npy"), mmap_mode="c")
+
+    def image(self, idx) :
+        # zero-copy HWC view, matching the PIL/ToTensor layout
+        self._open()
+        return self.images[idx].transpose(1, 2, 0)
+
+    def label(self, idx) :
+        self._open()
+        return self.labels[idx]
+
+    def __getitem__(self, idx) :
+        return self.image(idx), self.label(idx)
+
+    def __getstate__(self) :
+        state = self.__dict__.copy()
+        state["images"] = None
+        state["labels"] = None
+        return state
+
+def compile_cache(label_path, image_path, cache_dir, resize=None) :
+    """Decode and resize every labelled sample once into `cache_dir`.
+
+    The cache is written to a temporary directory and renamed into place, so an
+    interrupted compile never leaves a half-written cache behind. When another
+    process finishes the same cache first, its copy is kept and this one dropped.
+    manifest.json records the sources and the size, see `check_cache`.
+    """
+    if resize is None :
+        resize = transforms.Resize((256, 256))
+    height, width = resize.size
+    data_list = os.listdir(label_path)
+
+    tmp_dir = cache_dir.rstrip(os.sep) + ".tmp-{}".format(os.getpid())
+    os.makedirs(tmp_dir)
+    try :
+        images = np.lib.format.open_memmap(os.path.join(tmp_dir, "images.npy"), mode="w+",
+                                           dtype=np.uint8, shape=(len(data_list), 3, height, width))
+        labels = np.lib.format.open_memmap(os.path.join(tmp_dir, "labels.npy"), mode="w+",
+                                           dtype=np.uint8, shape=(len(data_list), height, width))
+        for i, base in enumerate(data_list) :
+            image, label = load_resized(label_path, image_path, base, resize)
+            images[i] = image.transpose(2, 0, 1)
+            labels[i] = label
+        images.flush()
+        labels.flush()
+        del images, labels
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f :
+            json.dump(cache_manifest(label_path, image_path, resize), f, indent=2)
+        with open(os.path.join(tmp_dir, "index.txt"), "w") as f :
+            f.write("\n".join(data_list) + "\n")
+    except BaseException :
+        # an interrupted compile would otherwise leave a full-size copy behind
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try :
+        os.rename(tmp_dir, cache_dir)
+    except OSError :
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(cache_dir, "index.txt")) :
+            raise
+    return cache_dir
+
+def cache_manifest(label_path, image_path, resize) :
+    return dict(label_path=os.path.realpath(label_path), image_path=os.path.realpath(image_path),
+                size=list(resize.size))
+
+def check_cache(cache_dir, label_path, image_path, resize) :
+    """Raises ValueError unless the cache was compiled from these sources, at this size, with the current label files."""
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    if os.path.exists(manifest_path) :
+        with open(manifest_path) as f :
+            manifest = json.load(f)
+        expected = cache_manifest(label_path, image_path, resize)
+        for key, value in expected.items() :
+            if manifest.get(key) != value :
+                raise ValueError("cache {} was compiled with {} = {}, not {}; delete it or use another cache directory".format(
+                    cache_dir, key, manifest.get(key), value))
+    with open(os.path.join(cache_dir, "index.txt")) as f :
+        cached = set(f.read().split())
+    current = set(os.listdir(label_path))
+    if cached != current :
+        raise ValueError("cache {} is stale: {} label files added and {} removed since it was compiled; "
+                         "delete it to recompile".format(cache_dir, len(current - cached), len(cached - current)))
+
+def open_cache(cache_dir, label_path, image_path, resize=None) :
+    if resize is None :
+        resize = transforms.Resize((256, 256))
+    if not os.path.exists(os.path.join(cache_dir, "index.txt")) :
+        compile_cache(label_path, image_path, cache_dir, resize)
+    check_cache(cache_dir, label_path, image_path, resize)
+    return voc_cache(cache_dir)
+
+def worker_init_fn(worker_id) :
+    # torch gives every worker its own seed (base seed + worker id, redrawn each
+    # epoch unless workers persist) but numpy and random are forked unchanged,
+    # so without this every worker would draw the same cutout boxes
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+def build_loader(dataset, batch_size, sampler=None, workers=0, prefetch_factor=2, persistent_workers=False,
+                 pin_memory=False, generator=None, collate_fn=None) :
+    # prefetch_factor and persistent_workers are only valid with worker processes
+    kwargs = {}
+    if workers > 0 :
+        kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, sampler=sampler, num_workers=workers,
+                      pin_memory=pin_memory, worker_init_fn=worker_init_fn, generator=generator,
+                      collate_fn=collate_fn, **kwargs)
+
+class batch_augment(object):
+    """Batch-level augmentation run after collation, on whatever device the batch is on.
+
+    Takes an (N, 3, H, W) image batch, uint8 from datasets built with
+    normalize=False or float in [0, 1], plus any number of (N, H, W) label
+    batches. Random crops (zero padding of `crop_padding` then an H x W window)
+    and horizontal flips are drawn per sample and applied identically to the
+    images and every label batch; cutout masks follow `cutout` (box of
+    `mask_size` centred inside the image, applied with probability p) and are
+    image-only. Normalization comes last. All randomness is drawn from one
+    torch generator, seeded with `seed` when given.
+    """
+    def __init__(self, cut_out=False, flip=False, crop_padding=0, mask_size=32, p=0.5, seed=None,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)) :
+        self.cut_out = cut_out
+        self.flip = flip
+        self.crop_padding = crop_padding
+        self.mask_size = mask_size
+        self.p = p
+        self.seed = seed
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.generator = None
+        self.pending_state = None
+
+    def get_state(self) :
+        # the torch.Generator interface, so checkpoints can carry the stream;
+        # None until the first batch creates the generator
+        return None if self.generator is None else self.generator.get_state()
+
+    def set_state(self, state) :
+        if self.generator is None :
+            self.pending_state = state
+        else :
+            self.generator.set_state(state)
+
+    def _rand(self, *size, device=None) :
+        if self.generator is None or self.generator.device != device :
+            self.generator = torch.Generator(device=device)
+            if self.seed is not None :
+                self.generator.manual_seed(self.seed)
+            else :
+                self.generator.seed()
+            if self.pending_state is not None :
+                self.generator.set_state(self.pending_state)
+                self.pending_state = None
+        return torch.rand(*size, generator=self.generator, device=device)
+
+    def _randint(self, low, high, size, device) :
+        return (low + self._rand(size, device=device) * (high - low)).long().clamp_(max=high - 1)
+
+    def __call__(self, images, *labels) :
+        device = images.device
+        n, _, h, w = images.shape
+        if images.dtype == torch.uint8 :
+            x = images.float().div_(255)
+        else :
+            x = images.float()
+
+        if self.crop_padding > 0 :
+            pad = self.crop_padding
+            rows = self._randint(0, 2 * pad + 1, n, device)[:, None] + torch.arange(h, device=device)
+            cols = self._randint(0, 2 * pad + 1, n, device)[:, None] + torch.arange(w, device=device)
+            batch = torch.arange(n, device=device)[:, None, None]
+            x = F.pad(x, (pad, pad, pad, pad))[batch, :, rows[:, :, None], cols[:, None, :]]
+            x = x.permute(0, 3, 1, 2).contiguous()
+            labels = tuple(F.pad(l, (pad, pad, pad, pad))[batch, rows[:, :, None], cols[:, None, :]] for l in labels)
+
+        if self.flip :
+            flipped = self._rand(n, device=device) < 0.5
+            x = torch.where(flipped[:, None, None, None], x.flip(3), x)
+            labels = tuple(torch.where(flipped[:, None, None], l.flip(2), l) for l in labels)
+
+        if self.cut_out :
+            half = self.mask_size // 2
+            offset = 1 if self.mask_size % 2 == 0 else 0
+            cx = self._randint(half, w + offset - half, n, device)
+            cy = self._randint(half, h + offset - half, n, device)
+            apply = self._rand(n, device=device) <= self.p
+            ys = torch.arange(h, device=device)[None, :, None]
+            xs = torch.arange(w, device=device)[None, None, :]
+            ymin, xmin = (cy - half)[:, None, None], (cx - half)[:, None, None]
+            box = (ys >= ymin) & (ys < ymin + self.mask_size) & (xs >= xmin) & (xs < xmin + self.mask_size)
+            x.masked_fill_((box & apply[:, None, None])[:, None], 0)
+
+        x = (x - self.mean.to(device)) / self.std.to(device)
+        return (x,) + labels
+
+class cutout(object):
+    # a module-level class rather than a closure, so datasets holding one
+    # still pickle for spawn/forkserver DataLoader workers
+    def __init__(self, mask_size, p, cutout_inside, mask_color=(0, 0, 0)):
+        self.mask_size = mask_size
+        self.p = p
+        self.cutout_inside = cutout_inside
+        self.mask_color = mask_color
+
+    def __call__(self, image):
+        mask_size = self.mask_size
+        mask_size_half = mask_size // 2
+        offset = 1 if mask_size % 2 == 0 else 0
         image = np.asarray(image).copy()
 
-        if np.random.random() > p:
+        if np.random.random() > self.p:
             return image
         h, w = image.shape[:2]
 
-        if cutout_inside:
+        if self.cutout_inside:
             cxmin, cxmax = mask_size_half, w + offset - mask_size_half
             cymin, cymax = mask_size_half, h + offset - mask_size_half
         else:
@@ -148,7 +485,5 @@ def cutout(mask_size, p, cutout_inside, mask_color=(0, 0, 0)):
         ymin = max(0, ymin)
         xmax = min(w, xmax)
         ymax = min(h, ymax)
-        image[ymin:ymax, xmin:xmax] = mask_color
-        return image
-
-    return _cutout
\ No newline at end of file
+        image[ymin:ymax, xmin:xmax] = self.mask_color
+        return image
\ No newline at end of file
@@ -1,12 +1,13 @@
 import dataset
 import torch 
 import torch.nn.functional as F
-import copy
 import time
+import contextlib
 from torch import nn 
-from torch.autograd import Variable
 from torch.utils import data as da 
 from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 import torchvision.transforms as transforms
 from torchvision.datasets import voc
 import os 
@@ -16,10 +17,15 @@ from torchsummary import summary
 import torchvision 
 import torch.backends.cudnn as cudnn
 from unet import Unet2D
-from utils import optimize_linear
+from attacks import attack_sweep, multilabel_flipped, free_step
 from losses import DiceLoss, SmoothCrossEntropyLoss
+from metrics import ConfusionMatrix, ScoreCollector, RunningStat
+from checkpoint import CheckpointManager
+from distributed import init_distributed, cleanup_distributed, is_main_process, all_reduce_mean, barrier
+from logger import MetricsLogger
+from profiling import StageTimer, ProfilerWindow
 import numpy as np
-from sklearn.metrics import accuracy_score, precision_score, average_precision_score, jaccard_score
+import json
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--mode", default="segmentation", type=str, help="Task Type, For example segmentation or classification")
@@ -31,196 +37,375 @@ parser.add_argument("--exp", default="Test", type=str)
 parser.add_argument("--tricks", default="None", type=str)
 parser.add_argument("--batch-train", default=8, type=int)
 parser.add_argument("--batch-val", default=8, type=int)
+parser.add_argument("--accum-steps", default=1, type=int, help="Micro-batches of --batch-train per optimizer step, the effective batch is their product")
+parser.add_argument("--norm", default="batch", type=str, help="Unet2D normalization: batch, sync (SyncBatchNorm) or group (GroupNorm, batch-size independent)")
+parser.add_argument("--adv-eps", default=[0.25], type=float, nargs="+", help="Perturbation sizes evaluated with --method adv")
+parser.add_argument("--attack", default="fgsm", type=str, help="Adversarial attack for --method adv: fgsm, pgd or bim")
+parser.add_argument("--adv-norm", default="inf", type=str, help="Norm of the perturbation ball: inf, 1 or 2")
+parser.add_argument("--adv-iters", default=10, type=int, help="Iterations of pgd/bim")
+parser.add_argument("--adv-early-stop", action="store_true", help="Stop pgd/bim per sample once every clean-correct label has flipped (classification; fgsm is single-step)")
+parser.add_argument("--adv-step", default=0.01, type=float, help="Step size of pgd/bim")
+parser.add_argument("--adv-train", default="none", type=str, help="Train on adversarial examples: none, fgsm, pgd or free")
+parser.add_argument("--adv-train-eps", default=0.25, type=float, help="Perturbation size for --adv-train")
+parser.add_argument("--free-replays", default=4, type=int, help="Minibatch replays of --adv-train free; divide --epochs by this for the same cost")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+parser.add_argument("--foreach", action="store_true", help="Use the multi-tensor (foreach) RAdam update; saves kernel launches on CUDA, no faster than the loop on CPU")
+parser.add_argument("--precision", default="fp32", type=str, help="fp32, or bf16 to run forward passes and losses under autocast")
+parser.add_argument("--workers", default=0, type=int, help="DataLoader worker processes")
+parser.add_argument("--prefetch-factor", default=2, type=int, help="Batches loaded in advance by each worker")
+parser.add_argument("--persistent-workers", action="store_true", help="Keep DataLoader workers alive between epochs")
+parser.add_argument("--pin-memory", action="store_true", help="Collate batches into pinned memory for faster device copies")
+parser.add_argument("--seed", default=None, type=int, help="Seed for torch, numpy, the samplers and (via worker_init_fn) the loader workers")
+parser.add_argument("--cache-dir", default=None, type=str, help="Directory of the preprocessed VOC cache, compiled on first use")
+parser.add_argument("--label-index", default=None, type=str, help="Class bitmask index for classification, built on first use; default next to the cache or the labels")
+parser.add_argument("--imagesets", default=None, type=str, help="ImageSets/Main directory to read the classification labels from (PNGs for images it lacks)")
+parser.add_argument("--batch-augment", action="store_true", help="Run cutout, flips, crops and normalization on the collated batch instead of per sample")
+parser.add_argument("--flip", action="store_true", help="Random horizontal flips (with --batch-augment)")
+parser.add_argument("--crop-padding", default=0, type=int, help="Random crops after zero padding by this many pixels (with --batch-augment)")
+parser.add_argument("--grad-checkpoint", default="none", type=str, help="Unet2D activation checkpointing: none, center or all")
+parser.add_argument("--checkpoint-dir", default=None, type=str, help="Where checkpoints and loss/accuracy histories go, default checkpoints/<mode>-<method>-<tricks>")
+parser.add_argument("--checkpoint-interval", default=25, type=int, help="Save a checkpoint every this many epochs (and after the last one)")
+parser.add_argument("--keep-checkpoints", default=3, type=int, help="Checkpoints kept on disk, 0 keeps all")
+parser.add_argument("--resume", default=None, type=str, help="Checkpoint to resume from, or 'latest' for the newest one in --checkpoint-dir")
+parser.add_argument("--threads", default=0, type=int, help="torch intra-op threads, 0 keeps the default")
+parser.add_argument("--summary", default=None, type=str, help="Write the final losses and measures of the run as JSON")
+parser.add_argument("--metrics", default=None, type=str, help="JSON-lines metrics log, default <checkpoint-dir>/metrics.jsonl")
+parser.add_argument("--loss-sync", default=50, type=int, help="Steps between reads of the running epoch losses off the device")
+parser.add_argument("--print-interval", default=10., type=float, help="Seconds between per-step console lines, 0 prints every step")
+parser.add_argument("--sync-timing", action="store_true", help="Synchronize CUDA at every timed stage boundary for an accurate per-stage split")
+parser.add_argument("--profile-steps", default=None, type=int, nargs=2, help="Capture training steps [N, M) (counted across epochs) with torch.profiler")
+parser.add_argument("--profile-trace", default=None, type=str, help="Chrome trace of --profile-steps, default <checkpoint-dir>/trace.json")
+parser.add_argument("--dist-backend", default="gloo", choices=["gloo", "nccl"], help="torch.distributed backend when launched with torchrun; nccl needs CUDA")
 args = parser.parse_args()
-
-def train(model, trn_loader, criterion, optimizer, epoch, mode="classification"):
-    trn_loss = 0
+if args.accum_steps < 1 :
+    parser.error("--accum-steps must be at least 1")
+if args.accum_steps > 1 and args.adv_train == "free" :
+    parser.error("--adv-train free steps the optimizer on every replay and cannot accumulate gradients")
+args.adv_norm = np.inf if args.adv_norm == "inf" else int(args.adv_norm)
+if args.checkpoint_dir is None :
+    args.checkpoint_dir = os.path.join("checkpoints", "{}-{}-{}".format(args.mode, args.method, args.tricks))
+# under torchrun every process trains on its shard of the split (--batch-train
+# is per process); rank 0 alone logs, profiles and checkpoints
+if args.dist_backend == "nccl" and not args.device.startswith("cuda") :
+    parser.error("--dist-backend nccl needs a CUDA --device")
+rank, world_size, local_rank = init_distributed(args.dist_backend)
+device = torch.device(args.device)
+if world_size > 1 and device.type == "cuda" :
+    device = torch.device("cuda", local_rank)
+if args.norm == "sync" and args.mode == "segmentation" and world_size > 1 and device.type != "cuda" :
+    parser.error("SyncBatchNorm needs CUDA devices; use --norm group on CPU")
+logger = MetricsLogger(args.metrics or os.path.join(args.checkpoint_dir, "metrics.jsonl"), print_seconds=args.print_interval,
+                       enabled=is_main_process())
+profiler = ProfilerWindow(*(args.profile_steps if args.profile_steps and is_main_process() else (None, None)),
+                          trace_path=args.profile_trace or os.path.join(args.checkpoint_dir, "trace.json"))
+
+def autocast():
+    # parameters, gradients and optimizer state stay fp32; only the forward
+    # pass and the loss run in bfloat16 where autocast deems it safe
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.precision == "bf16")
+
+def train(model, trn_loader, criterion, optimizer, epoch, mode="classification", augment=None):
+    trn_loss = RunningStat(sync_every=args.loss_sync)
     start_time = time.time()
     sum_total = 0 
-    total_prob = np.zeros((0,20))
-    total_target = np.zeros((0,20))
-
+    scores = ScoreCollector(len(trn_loader.sampler), 20, device=device)
+    confusion = ConfusionMatrix(21, device=device)
+    timer = StageTimer(sync=args.sync_timing)
+    # perturbation carried across minibatches by free adversarial training
+    delta = None
+    replays = args.free_replays if args.adv_train == "free" else 1
+    # gradients of --accum-steps micro-batches are summed before every optimizer step
+    accum_steps = args.accum_steps
+    group_loss = 0.
+    group_images = 0
+    optimizer.zero_grad()
+
+    data_start = time.perf_counter()
     for i, (image, target, file_name, non_smooth_target) in enumerate(trn_loader) :
+        timer.add("data", time.perf_counter() - data_start)
+        profiler.step(epoch * len(trn_loader) + i)
         model.train()
-        x = image.cuda()
-        y = target.cuda()
-        y_pred = model(x)  
-        ious = np.zeros((21,))
-        if mode == "classification" : 
-            total_target = np.concatenate((total_target, target))
+        with timer.stage("copy") :
+            x = image.to(device, non_blocking=True)
+            y = target.to(device, non_blocking=True)
+            if augment is not None :
+                if mode == "segmentation" :
+                    x, y, non_smooth_target = augment(x, y, non_smooth_target.to(device, non_blocking=True))
+                else :
+                    x, = augment(x)
+            if mode == "segmentation" : 
+                y = y.long()
+
+        if args.adv_train in ("fgsm", "pgd") :
+            # craft the batch against the current weights in eval mode, so the
+            # attack's forward passes leave the BatchNorm statistics alone
+            model.eval()
+            attack_kwargs = {} if args.adv_train == "fgsm" else dict(eps_iter=args.adv_step, nb_iter=args.adv_iters)
+            # DDP expects a weight gradient after every forward, so attack the bare module
+            attack_model = model.module if isinstance(model, DistributedDataParallel) else model
+            with timer.stage("attack"), autocast() :
+                _, x = next(attack_sweep(args.adv_train, attack_model, x, y, criterion, args.adv_train_eps, norm=args.adv_norm, **attack_kwargs))
+            model.train()
+
+        elif args.adv_train == "free" :
+            if delta is None or delta.shape[1:] != x.shape[1:] :
+                delta = torch.zeros_like(x)
+            batch_delta = delta[:x.size(0)]
+
+        # the last group of an epoch may be short; dividing by its real size
+        # keeps every update the mean gradient of the micro-batches it saw
+        group_start = i - i % accum_steps
+        accum = min(accum_steps, len(trn_loader) - group_start)
+        boundary = i + 1 == group_start + accum
+        # DDP all-reduces the gradients only on the micro-batch closing a group
+        no_sync = model.no_sync if isinstance(model, DistributedDataParallel) and not boundary else contextlib.nullcontext
+
+        # free adversarial training replays the minibatch and reuses the input
+        # gradient of each weight update for the next perturbation
+        for replay in range(replays) :
+            if args.adv_train == "free" :
+                x_in = (x + batch_delta).requires_grad_(True)
+            else :
+                x_in = x
+            with autocast() :
+                with timer.stage("forward") :
+                    y_pred = model(x_in)  
+                with timer.stage("loss") :
+                    loss = criterion(y_pred, y)
 
-        if mode == "segmentation" : 
-            loss = criterion(y_pred, y.long())
-            pred= F.softmax(y_pred, dim= 1)
-            _, max_index = torch.max(pred, 1)
-            index_flatten = max_index.view(-1).cpu()
-            target_flatten = non_smooth_target.view(-1).cpu()
-            li = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
-            iou = jaccard_score(index_flatten, target_flatten, labels=li ,average=None)
-            ious += iou
-            measure = 0
-
-        elif mode == "classification" :
-            loss = criterion(y_pred, y)
-            pos_probs = torch.sigmoid(y_pred)
-            total_prob = np.concatenate((total_prob, pos_probs.detach().cpu().numpy()))
-                
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-                       
-        trn_loss += (loss)
+            with timer.stage("backward"), no_sync() :
+                (loss / accum).backward()
+            if boundary :
+                with timer.stage("optimizer") :
+                    optimizer.step()
+                    optimizer.zero_grad()
 
-        end_time = time.time()
-        start_time = time.time()
-        print(" [Training] [{0}] [{1}/{2}]".format(epoch, i, len(trn_loader)))
+            if args.adv_train == "free" :
+                with timer.stage("attack") :
+                    free_step(batch_delta, x_in.grad, args.adv_train_eps, args.adv_norm)
+
+        with timer.stage("metrics") :
+            if mode == "segmentation" : 
+                confusion.update(y_pred.detach().argmax(dim=1), non_smooth_target)
 
-    trn_loss = trn_loss/len(trn_loader)
+            elif mode == "classification" :
+                scores.update(torch.sigmoid(y_pred.detach()), non_smooth_target)
+                       
+            trn_loss.update(loss)
+            group_loss += loss.detach()
+            group_images += x.size(0)
+
+        data_start = time.perf_counter()
+        if not boundary :
+            continue
+        # one record per optimizer step; the loss stays on the device until the
+        # logger flushes or the console line is printed
+        step_loss = group_loss / accum
+        stages = timer.step()
+        step_time = sum(stages.values())
+        logger.log("train_step", epoch=epoch, step=i // accum_steps, loss=step_loss, images=group_images, step_time=step_time,
+                   images_per_sec=group_images / step_time, **{name + "_time" : t for name, t in stages.items()})
+        logger.console(lambda : " [Training] [{0}] [{1}/{2}] Loss = [{3:.4f}] EMA = [{4:.4f}] Data(Seconds) = [{5:.3f}] Step(Seconds) = [{6:.3f}]".format(
+            epoch, i+1, len(trn_loader), float(step_loss), trn_loss.ema, stages.get("data", 0.), step_time))
+        group_loss = 0.
+        group_images = 0
+
+    end_time = time.time()
+    trn_loss = trn_loss.mean
+    if world_size > 1 :
+        trn_loss = all_reduce_mean(trn_loss)
+        if mode == "segmentation" :
+            confusion.all_reduce()
+        else :
+            scores.all_gather()
     if mode == "classification" :
-        total_measure = average_precision_score(total_target, total_prob)
+        total_measure = scores.mean_average_precision()
+        mean_measure = total_measure
+        logger.log("train_epoch", epoch=epoch, loss=trn_loss, mAP=total_measure, per_class_ap=scores.average_precision())
 
     if mode == "segmentation" : 
-        total_measure = ious
+        total_measure = confusion.iou()
+        mean_measure = confusion.mean_iou()
+        logger.log("train_epoch", epoch=epoch, loss=trn_loss, mIoU=confusion.mean_iou(), pixel_accuracy=confusion.pixel_accuracy(), per_class_iou=total_measure)
+        print(" [Training] [{0}] mIoU = [{1:.3f}] Pixel Accuracy = [{2:.3f}]".format(epoch, confusion.mean_iou(), confusion.pixel_accuracy()))
 
-    if epoch == 24 or epoch == 49 or epoch == 74 or epoch == 99  or epoch == 124 or epoch == 149 or epoch == 174 or epoch == 199: 
-        if not os.path.exists('/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/'.format(args.mode, args.method, args.tricks)):
-            os.makedirs('/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/'.format(args.mode, args.method, args.tricks))
-        torch.save(model.state_dict(), '/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/{}-model.pth'.format(args.mode, args.method, args.tricks, epoch))
-    
-    print(" [Training] [{0}] [{1}/{2}] Losses = [{3:.4f}] Time(Seconds) = [{4:.2f}] Measure = [{5:.3f}]".format(epoch, i+1, len(trn_loader), trn_loss, end_time - start_time, end_time - start_time))
+    logger.log("train_timing", epoch=epoch, seconds=end_time - start_time, steps=timer.steps, stages=timer.summary())
+    print(" [Training] [{0}] [{1}/{2}] Losses = [{3:.4f}] Time(Seconds) = [{4:.2f}] Measure = [{5:.3f}]".format(epoch, i+1, len(trn_loader), trn_loss, end_time - start_time, mean_measure))
+    print(" [Training] [{0}] Time split: {1}".format(epoch, timer.format()))
 
     return trn_loss, total_measure
 
-def validate(model, val_loader, criterion, criterion_fn, optimizer, epoch, mode="segmentation"):
-    val_loss = 0 
+def validate(model, val_loader, criterion, criterion_fn, optimizer, epoch, mode="segmentation", augment=None):
+    val_loss = RunningStat(sync_every=args.loss_sync)
+    # no weight gradients here, so the bare module avoids DDP's gradient bookkeeping
+    if isinstance(model, DistributedDataParallel) :
+        model = model.module
     model.eval()
-    adv_losses = 0
     start_time = time.time()
     sum_total = 0 
-    ious = np.zeros((21, ))
-    total_prob = np.zeros((0, 20))
-    total_target = np.zeros((0, 20))
+    confusion = ConfusionMatrix(21, device=device)
+    scores = ScoreCollector(len(val_loader.sampler), 20, device=device)
+    timer = StageTimer(sync=args.sync_timing)
 
     if args.method == 'adv' :
-        for i, (data, target, file_name, non_smooth_target) in enumerate(val_loader) :
-            x = data.cuda()
-            y = target.cuda()
-            if mode == "classification" :
-                total_target = np.concatenate((total_target, target))
-
-            x_clone = Variable(x.clone().detach(), requires_grad=True).cuda()
-            model_fn = copy.deepcopy(model)
-
-            if mode == "segmentation" : 
-                loss_fn = criterion_fn(model_fn(x_clone), y.detach().long())
+        # one meter per epsilon; the first epsilon is the one reported back to main()
+        adv_losses = [RunningStat(sync_every=args.loss_sync) for _ in args.adv_eps]
+        adv_confusion = [ConfusionMatrix(21, device=device) for _ in args.adv_eps]
+        adv_scores = [ScoreCollector(len(val_loader.sampler), 20, device=device) for _ in args.adv_eps]
 
-            elif mode == "classification" :
-                loss_fn = criterion_fn(model_fn(x_clone), y.detach())
-
-            optimizer.zero_grad()
-            loss_fn.backward()
-
-            grads = x_clone.grad
-
-            # calculate perturbations of the inputs
-            scaled_perturbation = optimize_linear(grads, eps=0.25, norm=np.inf)
-            # make adversarial samples
-            adv_x = Variable(x_clone+scaled_perturbation, requires_grad=True).cuda()
-            
-            adv_y_pred = model_fn(adv_x)
-
-            if mode == "segmentation" : 
-                adv_loss = criterion_fn(adv_y_pred, y.detach().long())
-                pred= F.softmax(adv_y_pred, dim= 1)
-                _, max_index = torch.max(pred, 1)
-                index_flatten = max_index.view(-1).cpu()
-                target_flatten = non_smooth_target.view(-1).cpu()
-                li = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
-                iou = jaccard_score(index_flatten, target_flatten, labels=li, average=None)
-                ious += iou
-                measure = 0 
-
-            elif mode == "classification" :
-                
-                pos_probs = torch.sigmoid(adv_y_pred)
-                pos_preds = (pos_probs > 0.5).float()
-                adv_loss = criterion_fn(adv_y_pred, y.detach())
-                total_prob = np.concatenate((total_prob, pos_probs.detach().cpu().numpy()))
-
-            adv_losses += adv_loss.item()
-            
-            optimizer.zero_grad()
-
-            end_time = time.time()
-            print(" [Validation] [{0}] [{1}/{2}]".format(epoch, i+1, len(val_loader)))
-            start_time = time.time()
+        data_start = time.perf_counter()
+        for i, (data, target, file_name, non_smooth_target) in enumerate(val_loader) :
+            timer.add("data", time.perf_counter() - data_start)
+            with timer.stage("copy") :
+                x = data.to(device, non_blocking=True)
+                y = target.to(device, non_blocking=True)
+                if augment is not None :
+                    x, = augment(x)
+                if mode == "segmentation" :
+                    y = y.long()
+
+            # adversarial samples from input gradients of the eval-mode model; with
+            # --adv-early-stop the iterative attacks stop per sample once every
+            # label the clean input got right has flipped
+            success_fn = None
+            if args.adv_early_stop and args.attack != "fgsm" and mode == "classification" :
+                with timer.stage("attack"), torch.no_grad(), autocast() :
+                    success_fn = multilabel_flipped(model(x), y)
+            attack_kwargs = {} if args.attack == "fgsm" else dict(eps_iter=args.adv_step, nb_iter=args.adv_iters, success_fn=success_fn)
+            adv_batches = iter(attack_sweep(args.attack, model, x, y, criterion_fn, args.adv_eps, norm=args.adv_norm, **attack_kwargs))
+            with autocast() :
+                for k in range(len(args.adv_eps)) :
+                    # the sweep is lazy, the attack runs when the next batch is drawn
+                    with timer.stage("attack") :
+                        eps, adv_x = next(adv_batches)
+                    with torch.no_grad() :
+                        with timer.stage("forward") :
+                            adv_y_pred = model(adv_x)
+                        with timer.stage("loss") :
+                            adv_loss = criterion_fn(adv_y_pred, y)
+
+                    with timer.stage("metrics") :
+                        if mode == "segmentation" : 
+                            adv_confusion[k].update(adv_y_pred.argmax(dim=1), non_smooth_target)
+
+                        elif mode == "classification" :
+                            adv_scores[k].update(torch.sigmoid(adv_y_pred), non_smooth_target)
+
+                        adv_losses[k].update(adv_loss)
+
+            stages = timer.step()
+            logger.log("val_step", epoch=epoch, step=i, adv_loss=adv_loss, images=x.size(0), step_time=sum(stages.values()), **{name + "_time" : t for name, t in stages.items()})
+            logger.console(" [Validation] [{0}] [{1}/{2}]".format(epoch, i+1, len(val_loader)))
+            data_start = time.perf_counter()
     else  :
-        with torch.no_grad() :
+        with torch.no_grad(), autocast() :
+            data_start = time.perf_counter()
             for i, (data, target, file_name, non_smooth_target) in enumerate(val_loader) :
-                x = data.cuda()
-                y = target.cuda()
-
-                y_pred = model(x)
-                if mode == "classification" : 
-                    total_target = np.concatenate((total_target, target))
-
-                if mode == "segmentation" : 
-                    loss = criterion(y_pred, y.long())
-                    pred= F.softmax(y_pred, dim= 1)
-                    _, max_index = torch.max(pred, 1)
-                    index_flatten = max_index.view(-1).cpu()
-                    target_flatten = non_smooth_target.view(-1).cpu()
-                    li = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
-                    iou = jaccard_score(index_flatten, target_flatten, labels=li, average=None)
-                    ious += iou
-                    measure = 0 
-
-                elif mode == "classification" :
+                timer.add("data", time.perf_counter() - data_start)
+                with timer.stage("copy") :
+                    x = data.to(device, non_blocking=True)
+                    y = target.to(device, non_blocking=True)
+                    if augment is not None :
+                        x, = augment(x)
+                    if mode == "segmentation" : 
+                        y = y.long()
+
+                with timer.stage("forward") :
+                    y_pred = model(x)
+                with timer.stage("loss") :
                     loss = criterion(y_pred, y)
-                    pos_probs = torch.sigmoid(y_pred)
-                    pos_preds = (pos_probs > 0.5).float()
-                    total_prob = np.concatenate((total_prob, pos_probs.detach().cpu().numpy()))
 
-                val_loss += (loss)
+                with timer.stage("metrics") :
+                    if mode == "segmentation" : 
+                        confusion.update(y_pred.argmax(dim=1), non_smooth_target)
+
+                    elif mode == "classification" :
+                        scores.update(torch.sigmoid(y_pred), non_smooth_target)
 
-                end_time = time.time()
-                print(" [Validation] [{0}] [{1}/{2}]".format(epoch, i+1, len(val_loader)))
-                start_time = time.time()
+                    val_loss.update(loss)
 
+                stages = timer.step()
+                logger.log("val_step", epoch=epoch, step=i, loss=loss, images=x.size(0), step_time=sum(stages.values()), **{name + "_time" : t for name, t in stages.items()})
+                logger.console(" [Validation] [{0}] [{1}/{2}]".format(epoch, i+1, len(val_loader)))
+                data_start = time.perf_counter()
+
+    end_time = time.time()
+    logger.log("val_timing", epoch=epoch, seconds=end_time - start_time, steps=timer.steps, stages=timer.summary())
+    print(" [Validation] [{0}] Time split: {1}".format(epoch, timer.format()))
 
     if args.method != 'adv' :
-        val_loss = val_loss / len(val_loader)
+        val_loss = val_loss.mean
+        if world_size > 1 :
+            val_loss = all_reduce_mean(val_loss)
+            if mode == "segmentation" :
+                confusion.all_reduce()
+            else :
+                scores.all_gather()
         if mode == "segmentation" : 
-            mean_total = ious 
+            mean_total = confusion.iou()
+            logger.log("val_epoch", epoch=epoch, loss=val_loss, mIoU=confusion.mean_iou(), pixel_accuracy=confusion.pixel_accuracy(), per_class_iou=mean_total)
+            print(" [Validation] [{0}] mIoU = [{1:.3f}] Pixel Accuracy = [{2:.3f}]".format(epoch, confusion.mean_iou(), confusion.pixel_accuracy()))
         else :
-            mean_total = average_precision_score(total_target, total_prob)
-        print(" [Validation] [{0}] [{1}/{2}] Losses = [{3:.4f}] Time(Seconds) = [{4:.2f}] Measure [{5:.3f}]".format(epoch, i+1, len(val_loader), val_loss, end_time - start_time, end_time - start_time))
+            mean_total = scores.mean_average_precision()
+            logger.log("val_epoch", epoch=epoch, loss=val_loss, mAP=mean_total, per_class_ap=scores.average_precision())
+        print(" [Validation] [{0}] [{1}/{2}] Losses = [{3:.4f}] Time(Seconds) = [{4:.2f}] Measure [{5:.3f}]".format(epoch, i+1, len(val_loader), val_loss, end_time - start_time, float(np.nanmean(mean_total))))
         return val_loss, mean_total
 
     else : 
-        adv_losses /= len(val_loader)
-        if mode == "segmentation" : 
-            mean_total = ious 
-        else : 
-            mean_total = average_precision_score(total_target, total_prob)
-        return adv_losses, mean_total
+        for k, eps in enumerate(args.adv_eps) :
+            adv_losses[k] = adv_losses[k].mean
+            if world_size > 1 :
+                adv_losses[k] = all_reduce_mean(adv_losses[k])
+                if mode == "segmentation" :
+                    adv_confusion[k].all_reduce()
+                else :
+                    adv_scores[k].all_gather()
+            if mode == "segmentation" : 
+                measures = adv_confusion[k].iou()
+                logger.log("val_adv_epoch", epoch=epoch, eps=eps, loss=adv_losses[k], mIoU=adv_confusion[k].mean_iou(),
+                           pixel_accuracy=adv_confusion[k].pixel_accuracy(), per_class_iou=measures)
+                print(" [Validation] [{0}] Adversarial eps = [{1}] Losses = [{2:.4f}] mIoU = [{3:.3f}] Pixel Accuracy = [{4:.3f}]".format(epoch, eps, adv_losses[k], adv_confusion[k].mean_iou(), adv_confusion[k].pixel_accuracy()))
+            else : 
+                measures = adv_scores[k].mean_average_precision()
+                logger.log("val_adv_epoch", epoch=epoch, eps=eps, loss=adv_losses[k], mAP=measures, per_class_ap=adv_scores[k].average_precision())
+                print(" [Validation] [{0}] Adversarial eps = [{1}] Losses = [{2:.4f}] mAP = [{3:.3f}]".format(epoch, eps, adv_losses[k], measures))
+            if k == 0 :
+                mean_total = measures
+        return adv_losses[0], mean_total
     
+def summarize(tr_loss, tr_acc, val_loss, val_acc, seconds):
+    # last-epoch numbers; segmentation measures are per-class IoU, reported as their mean
+    def measure(m) :
+        return float(np.nanmean(m))
+    def scalar(v) :
+        return float(v.detach()) if torch.is_tensor(v) else float(v)
+    return dict(mode=args.mode, method=args.method, tricks=args.tricks, epochs=len(tr_loss), seconds=seconds,
+                train_loss=scalar(tr_loss[-1]) if tr_loss else None, train_measure=measure(tr_acc[-1]) if tr_acc else None,
+                val_loss=scalar(val_loss[-1]) if val_loss else None, val_measure=measure(val_acc[-1]) if val_acc else None)
+
 def main():
+    if args.threads > 0 :
+        torch.set_num_threads(args.threads)
+    # local rank 0 compiles the cache and the label index while the other
+    # ranks of its node wait, then they open the finished files
+    if local_rank != 0 :
+        barrier()
     if args.mode == "segmentation" :
         label_path = "seg_da/VOCdevkit/VOC2010/SegmentationClass/"
         image_path = "seg_da/VOCdevkit/VOC2010/JPEGImages"
 
         if args.tricks == "cut-out" :
-            trainset = dataset.voc_seg(label_path, image_path, cut_out=True, smooth=False)
-            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_seg(label_path, image_path, cut_out=True, smooth=False, cache_dir=args.cache_dir, normalize=not args.batch_augment)
+            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, normalize=not args.batch_augment)
         elif args.tricks == "smooth" :
-            trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=True)
-            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=True, cache_dir=args.cache_dir, normalize=not args.batch_augment)
+            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, normalize=not args.batch_augment)
         elif args.tricks == "all" :
-            trainset = dataset.voc_seg(label_path, image_path, cut_out=True, smooth=True)
-            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_seg(label_path, image_path, cut_out=True, smooth=True, cache_dir=args.cache_dir, normalize=not args.batch_augment)
+            valset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, normalize=not args.batch_augment)
         else :
-            trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth = False)
+            trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth = False, cache_dir=args.cache_dir, normalize=not args.batch_augment)
+            valset = trainset
         
         total_idx = list(range(len(trainset)))
         split_idx = int(len(trainset) * 0.7)
@@ -232,16 +417,17 @@ def main():
         image_path = "seg_da/VOCdevkit/VOC2010/JPEGImages"
 
         if args.tricks == "smooth" :
-            trainset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth = True)
-            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth = False)
+            trainset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth = True, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
+            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth = False, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
         elif args.tricks == "cut-out" :
-            trainset = dataset.voc_cls(info_path, image_path, cut_out=True, smooth=False)
-            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_cls(info_path, image_path, cut_out=True, smooth=False, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
+            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
         elif args.tricks == "all" :
-            trainset = dataset.voc_cls(info_path, image_path, cut_out=True, smooth =True)
-            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_cls(info_path, image_path, cut_out=True, smooth =True, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
+            valset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
         else :
-            trainset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False)
+            trainset = dataset.voc_cls(info_path, image_path, cut_out=False, smooth=False, cache_dir=args.cache_dir, label_index=args.label_index, imagesets_path=args.imagesets, normalize=not args.batch_augment)
+            valset = trainset
 
         total_idx = list(range(len(trainset)))
         split_idx = int(len(trainset) * 0.7)
@@ -249,16 +435,41 @@ def main():
         val_idx = total_idx[split_idx:]
     else : 
         raise NotImplementedError
-
-    if args.tricks == "smooth" or args.tricks == "cut-out" or args.tricks == "all" :
-        trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_train, shuffle=False, sampler=SubsetRandomSampler(trn_idx))
-        testloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_val, shuffle=False, sampler=SubsetRandomSampler(trn_idx))
+    if local_rank == 0 :
+        barrier()
+
+    generator = None
+    if args.seed is not None :
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        generator = torch.Generator()
+        generator.manual_seed(args.seed)
+
+    loader_config = dict(workers=args.workers, prefetch_factor=args.prefetch_factor, persistent_workers=args.persistent_workers,
+                         pin_memory=args.pin_memory and device.type == "cuda", generator=generator)
+    if world_size > 1 :
+        # every rank sees a disjoint shard of the split; the validation shards
+        # are padded with a few repeated samples to equal length
+        trainset, valset = da.Subset(trainset, trn_idx), da.Subset(valset, val_idx)
+        seed = args.seed if args.seed is not None else 0
+        trn_sampler = DistributedSampler(trainset, shuffle=True, seed=seed)
+        val_sampler = DistributedSampler(valset, shuffle=False)
     else :
-        trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_train, shuffle=False, sampler=SubsetRandomSampler(trn_idx))
-        testloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_val, shuffle=False, sampler=SubsetRandomSampler(trn_idx))
+        trn_sampler = SubsetRandomSampler(trn_idx, generator=generator)
+        val_sampler = SubsetRandomSampler(val_idx, generator=generator)
+    trainloader = dataset.build_loader(trainset, args.batch_train, trn_sampler, **loader_config)
+    testloader = dataset.build_loader(valset, args.batch_val, val_sampler, **loader_config)
+
+    # the datasets hand out uint8 images; cutout/flip/crop and normalization
+    # run on the whole batch after it reaches the device
+    trn_augment, val_augment = None, None
+    if args.batch_augment :
+        trn_augment = dataset.batch_augment(cut_out=args.tricks in ("cut-out", "all"), flip=args.flip,
+                                            crop_padding=args.crop_padding, seed=args.seed)
+        val_augment = dataset.batch_augment()
 
     if args.mode == "segmentation" :
-        net = Unet2D((3, 256, 256), 1, 0.1, num_classes=21)
+        net = Unet2D((3, 256, 256), 1, 0.1, num_classes=21, checkpoint=args.grad_checkpoint, norm=args.norm)
     elif args.mode == "classification" :
         net = torchvision.models.resnet50(pretrained=False, num_classes=20)
     else : 
@@ -269,24 +480,30 @@ def main():
     elif args.optim == 'adam' :
         optimizer = torch.optim.Adam(net.parameters(), lr=0.001)
     elif args.optim == 'radam' :
-        optimizer = RAdam(net.parameters(), lr = 0.0001)
+        optimizer = RAdam(net.parameters(), lr = 0.0001, foreach=args.foreach)
     else : 
         raise NotImplementedError
 
-    net = nn.DataParallel(net).cuda()
-    cudnn.benchmark = True
+    if world_size > 1 :
+        net = net.to(device)
+        net = DistributedDataParallel(net, device_ids=[device.index] if device.type == "cuda" else None)
+    elif device.type == "cuda" :
+        net = nn.DataParallel(net)
+    if device.type == "cuda" :
+        cudnn.benchmark = True
+    net = net.to(device)
 
     if args.loss_function == "bce" :
-        criterion = nn.BCEWithLogitsLoss().cuda()
-        criterion_fn = nn.BCEWithLogitsLoss().cuda()
+        criterion = nn.BCEWithLogitsLoss().to(device)
+        criterion_fn = nn.BCEWithLogitsLoss().to(device)
 
     elif args.loss_function == "dice" :
-        criterion = DiceLoss().cuda()
-        criterion_fn = DiceLoss().cuda()
+        criterion = DiceLoss().to(device)
+        criterion_fn = DiceLoss().to(device)
 
     elif args.loss_function == "cross_entropy" :
-        criterion = nn.CrossEntropyLoss().cuda()
-        criterion_fn = nn.CrossEntropyLoss().cuda()
+        criterion = nn.CrossEntropyLoss().to(device)
+        criterion_fn = nn.CrossEntropyLoss().to(device)
     else :
         raise NotImplementedError
     
@@ -294,24 +511,57 @@ def main():
     tr_acc = [] 
     val_losses = []
     val_acc = []
-    for epoch in range(args.epochs) : 
-        tr, tac = train(net, trainloader, criterion, optimizer, epoch, mode=args.mode)
-        va, vac = validate(net, testloader, criterion, criterion_fn, optimizer, epoch, mode=args.mode)
+    start_epoch = 0
+    # the seeded sampler/loader generator and the augmentation stream resume
+    # where they stopped instead of replaying epoch 0
+    generators = {}
+    if generator is not None :
+        generators["data"] = generator
+    if trn_augment is not None :
+        generators["augment"] = trn_augment
+    checkpoints = CheckpointManager(args.checkpoint_dir, interval=args.checkpoint_interval, keep=args.keep_checkpoints,
+                                    generators=generators)
+    if args.resume is not None :
+        resume_path = checkpoints.latest() if args.resume == "latest" else args.resume
+        if resume_path is None :
+            raise FileNotFoundError("No checkpoint to resume from in {}".format(args.checkpoint_dir))
+        last_epoch, history = checkpoints.load(resume_path, net, optimizer)
+        losses, tr_acc, val_losses, val_acc = history["losses"], history["tr_acc"], history["val_losses"], history["val_acc"]
+        start_epoch = last_epoch + 1
+        print(" [Resume] {} at epoch [{}]".format(resume_path, start_epoch))
+
+    for epoch in range(start_epoch, args.epochs) : 
+        if isinstance(trainloader.sampler, DistributedSampler) :
+            trainloader.sampler.set_epoch(epoch)
+        tr, tac = train(net, trainloader, criterion, optimizer, epoch, mode=args.mode, augment=trn_augment)
+        va, vac = validate(net, testloader, criterion, criterion_fn, optimizer, epoch, mode=args.mode, augment=val_augment)
         losses.append(tr)
         tr_acc.append(tac)
         val_losses.append(va)
         val_acc.append(vac)
+        # written by a background thread while the next epoch trains
+        if is_main_process() :
+            checkpoints.save(epoch, net, optimizer, last_epoch=args.epochs - 1,
+                             losses=losses, tr_acc=tr_acc, val_losses=val_losses, val_acc=val_acc)
+    checkpoints.wait()
 
     return losses, tr_acc, val_losses, val_acc
 
 
 if __name__ == '__main__':
-    tr_loss, tr_acc, val_loss, val_acc = main()
+    run_start = time.time()
+    # the log is flushed even when the run dies; the curves live in the
+    # metrics log and in the checkpoints instead of end-of-run pickles
+    logger.log("run_start", args=vars(args))
     try:
-        torch.save(tr_loss, '/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/{}-{}-{}-Trainloss.pkl'.format(args.mode, args.method, args.tricks, args.mode, args.method, str(args.epochs)))
-        torch.save(tr_acc, '/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/{}-{}-{}-Trainacc.pkl'.format(args.mode, args.method, args.tricks, args.mode, args.method, str(args.epochs)))
-        torch.save(val_loss, '/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/{}-{}-{}-Validloss.pkl'.format(args.mode, args.method, args.tricks, args.mode, args.method, str(args.epochs)))
-        torch.save(val_acc, '/data1/workspace/geongyu/deep_lr_prj/{}-{}-{}/{}-{}-{}-Validacc.pkl'.format(args.mode, args.method, args.tricks, args.mode, args.method, str(args.epochs)))
-    except : 
-        import ipdb; ipdb.set_trace()
+        tr_loss, tr_acc, val_loss, val_acc = main()
+        summary = summarize(tr_loss, tr_acc, val_loss, val_acc, time.time() - run_start)
+        logger.log("run_end", **summary)
+        if args.summary is not None and is_main_process() :
+            with open(args.summary, "w") as f :
+                json.dump(summary, f, indent=2)
+    finally :
+        profiler.close()
+        logger.close()
+        cleanup_distributed()
     
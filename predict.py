@@ -0,0 +1,184 @@
+import os
+import csv
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+import dataset
+from unet import Unet2D
+from inference import tiled_predict
+from utils import load_checkpoint
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--mode", default="segmentation", type=str, help="segmentation (PNG masks) or classification (multi-label scores)")
+parser.add_argument("--checkpoint", required=True, type=str, help="state_dict saved by main.py")
+parser.add_argument("--input", required=True, type=str, help="Directory of images")
+parser.add_argument("--output", required=True, type=str, help="Directory for the masks / scores.csv")
+parser.add_argument("--batch", default=8, type=int, help="Images (or tiles with --tiled) per forward pass")
+parser.add_argument("--size", default=256, type=int, help="Network input size")
+parser.add_argument("--tiled", action="store_true", help="Segment at native resolution with overlapping tiles")
+parser.add_argument("--overlap", default=64, type=int, help="Tile overlap in pixels with --tiled")
+parser.add_argument("--decode-workers", default=2, type=int)
+parser.add_argument("--writer-workers", default=2, type=int)
+parser.add_argument("--queue-size", default=4, type=int, help="Batches buffered between the pipeline stages")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+parser.add_argument("--threads", default=0, type=int, help="torch threads, 0 keeps the default")
+args = parser.parse_args()
+device = torch.device(args.device)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+_DONE = None
+
+
+def build_model():
+    if args.mode == "segmentation":
+        net = Unet2D((3, args.size, args.size), 1, 0.1, num_classes=21)
+    elif args.mode == "classification":
+        net = torchvision.models.resnet50(num_classes=20)
+    else:
+        raise NotImplementedError
+    load_checkpoint(args.checkpoint, net)
+    return net.to(device).eval()
+
+
+def decode(paths, decoded, errors):
+    # reads and resizes images; PIL releases the GIL while decoding
+    resize = None if args.tiled else dataset.transforms.Resize((args.size, args.size))
+    while True:
+        try:
+            path = paths.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            image = Image.open(path)
+            size = image.size
+            image = image.convert("RGB")
+            if resize is not None:
+                image = resize(image)
+            decoded.put((path, size, np.array(image)))
+        except Exception as e:
+            errors.append((path, e))
+    decoded.put(_DONE)
+
+
+def mask_name(path):
+    # the source extension stays in the name, so a.jpg and a.png get separate masks
+    return os.path.basename(path) + ".png"
+
+
+def write(results, scores_file, lock, errors):
+    # failures are recorded per image like decode errors; a writer that died
+    # would leave the bounded results queue full and block the forward loop
+    while True:
+        item = results.get()
+        if item is _DONE:
+            break
+        paths, sizes, outputs = item
+        if args.mode == "segmentation":
+            for path, size, mask in zip(paths, sizes, outputs):
+                try:
+                    mask = Image.fromarray(mask)
+                    if mask.size != size:
+                        mask = mask.resize(size, Image.NEAREST)
+                    mask.save(os.path.join(args.output, mask_name(path)))
+                except Exception as e:
+                    errors.append((path, e))
+        else:
+            rows = [[os.path.basename(path)] + ["{:.5f}".format(s) for s in score] for path, score in zip(paths, outputs)]
+            try:
+                with lock:
+                    scores_file.writerows(rows)
+            except Exception as e:
+                errors.extend((path, e) for path in paths)
+
+
+def forward(net, normalize, paths, sizes, images):
+    x = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).to(device, non_blocking=True)
+    x, = normalize(x)
+    with torch.no_grad():
+        y_pred = net(x)
+    if args.mode == "segmentation":
+        return paths, sizes, y_pred.argmax(dim=1).to("cpu", torch.uint8).numpy()
+    return paths, sizes, torch.sigmoid(y_pred).cpu().numpy()
+
+
+def forward_tiled(net, normalize, path, size, image):
+    x = torch.from_numpy(image).permute(2, 0, 1)[None].to(device)
+    x, = normalize(x)
+    mask = tiled_predict(net, x[0], 21, tile=args.size, overlap=args.overlap, batch_size=args.batch, labels=True)
+    return [path], [size], mask.numpy()[None]
+
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.tiled and args.mode != "segmentation":
+        raise ValueError("--tiled only applies to segmentation")
+    if os.path.realpath(args.input) == os.path.realpath(args.output):
+        raise ValueError("--output must differ from --input")
+    os.makedirs(args.output, exist_ok=True)
+
+    files = sorted(f for f in os.listdir(args.input) if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths = queue.Queue()
+    for f in files:
+        paths.put(os.path.join(args.input, f))
+
+    net = build_model()
+    normalize = dataset.batch_augment()
+
+    # bounded queues keep at most a few batches of decoded images and
+    # predictions alive, whatever the size of the directory
+    decoded = queue.Queue(maxsize=args.queue_size * args.batch)
+    results = queue.Queue(maxsize=args.queue_size)
+    errors = []
+    lock = threading.Lock()
+
+    scores_handle, scores_file = None, None
+    if args.mode == "classification":
+        scores_handle = open(os.path.join(args.output, "scores.csv"), "w", newline="")
+        scores_file = csv.writer(scores_handle)
+        scores_file.writerow(["image"] + dataset.object_categories)
+
+    decoders = [threading.Thread(target=decode, args=(paths, decoded, errors), daemon=True) for _ in range(args.decode_workers)]
+    writers = [threading.Thread(target=write, args=(results, scores_file, lock, errors), daemon=True) for _ in range(args.writer_workers)]
+    for t in decoders + writers:
+        t.start()
+
+    start_time = time.time()
+    done, count, batch = 0, 0, []
+    while done < len(decoders):
+        item = decoded.get()
+        flushed = 0
+        if item is _DONE:
+            done += 1
+        elif args.tiled:
+            results.put(forward_tiled(net, normalize, *item))
+            flushed = 1
+        else:
+            batch.append(item)
+        if batch and (len(batch) == args.batch or done == len(decoders)):
+            results.put(forward(net, normalize, *zip(*batch)))
+            flushed, batch = len(batch), []
+        if flushed:
+            count += flushed
+            print(" [Predict] [{0}/{1}] [{2:.2f} images/sec]".format(count, len(files), count / (time.time() - start_time)))
+
+    for _ in writers:
+        results.put(_DONE)
+    for t in writers:
+        t.join()
+    if scores_handle is not None:
+        scores_handle.close()
+
+    elapsed = time.time() - start_time
+    for path, e in errors:
+        print(" [Predict] skipped {}: {}".format(path, e))
+    print(" [Predict] {0} images in {1:.2f} seconds [{2:.2f} images/sec]".format(count, elapsed, count / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
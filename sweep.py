@@ -0,0 +1,142 @@
+import os
+import sys
+import csv
+import json
+import time
+import itertools
+import argparse
+import subprocess
+import dataset
+
+parser = argparse.ArgumentParser(description="Runs a grid of main.py configurations concurrently, each pinned to its own CPU cores")
+parser.add_argument("--grid", default=None, type=str, help="JSON grid spec; the run.sh grid when omitted")
+parser.add_argument("--output", default="sweeps/default", type=str, help="Per-run logs, checkpoints and the results table")
+parser.add_argument("--threads-per-run", default=4, type=int, help="CPU cores (and torch threads) given to every run")
+parser.add_argument("--max-runs", default=0, type=int, help="Concurrent runs, 0 fits as many as the cores allow")
+parser.add_argument("--cache-dir", default="cache", type=str, help="Preprocessed dataset cache shared by every run")
+parser.add_argument("--dry-run", action="store_true", help="Print the commands and exit")
+args = parser.parse_args()
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# run.sh / model_state_dict: {classification, segmentation} x {none, adv} x tricks
+DEFAULT_SPEC = {
+    "grid": {"mode": ["classification", "segmentation"], "method": ["none", "adv"],
+             "tricks": ["None", "cut-out", "smooth", "all"]},
+    "args": {"epochs": 50},
+    "overrides": {"mode=classification": {"loss-function": "bce"},
+                  "mode=segmentation": {"loss-function": "cross_entropy"}},
+}
+
+
+def expand(spec):
+    """
+      Every combination of spec["grid"], on top of spec["args"]. Entries of
+      spec["overrides"] keyed "name=value" apply to the runs where that
+      grid argument has that value.
+      :returns: list of (run name, {argument: value}) pairs
+      """
+    grid = spec.get("grid", {})
+    names = list(grid)
+    runs = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        config = dict(spec.get("args", {}))
+        config.update(zip(names, values))
+        for condition, extra in spec.get("overrides", {}).items():
+            key, value = condition.split("=", 1)
+            if str(config.get(key)) == value:
+                config.update(extra)
+        runs.append(("-".join(str(v) for v in values), config))
+    return runs
+
+
+def command(name, config, threads):
+    run_dir = os.path.join(args.output, name)
+    argv = [sys.executable, MAIN, "--cache-dir", args.cache_dir, "--threads", threads,
+            "--checkpoint-dir", run_dir, "--summary", os.path.join(run_dir, "summary.json")]
+    for key, value in config.items():
+        if value is True:
+            argv.append("--" + key)
+        elif value is not False and value is not None:
+            argv += ["--" + key] + [str(v) for v in (value if isinstance(value, list) else [value])]
+    return [str(a) for a in argv]
+
+
+def prepare_cache(runs):
+    # compile the cache (and the classification label index) once, before the
+    # runs start, so they share it instead of racing to build it
+    label_path = "seg_da/VOCdevkit/VOC2010/SegmentationClass/"
+    image_path = "seg_da/VOCdevkit/VOC2010/JPEGImages"
+    modes = set(config.get("mode") for _, config in runs)
+    if "classification" in modes:
+        dataset.voc_cls(label_path, image_path, cache_dir=args.cache_dir)
+    else:
+        dataset.voc_seg(label_path, image_path, cache_dir=args.cache_dir)
+
+
+def main():
+    if args.grid is not None:
+        with open(args.grid) as f:
+            spec = json.load(f)
+    else:
+        spec = DEFAULT_SPEC
+    runs = expand(spec)
+
+    cores = sorted(os.sched_getaffinity(0))
+    threads = max(1, min(args.threads_per_run, len(cores)))
+    slots = [cores[i:i + threads] for i in range(0, len(cores) - threads + 1, threads)]
+    if args.max_runs > 0:
+        slots = slots[:args.max_runs]
+
+    if args.dry_run:
+        for name, config in runs:
+            print(" ".join(command(name, config, threads)))
+        return
+
+    prepare_cache(runs)
+    os.makedirs(args.output, exist_ok=True)
+    print(" [Sweep] {} runs, {} at a time on {} cores each".format(len(runs), len(slots), threads))
+
+    pending = list(runs)
+    running = {}
+    results = []
+    free = list(slots)
+    while pending or running:
+        while pending and free:
+            name, config = pending.pop(0)
+            slot = free.pop(0)
+            os.makedirs(os.path.join(args.output, name), exist_ok=True)
+            log = open(os.path.join(args.output, name, "log.txt"), "w")
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+            proc = subprocess.Popen(command(name, config, threads), stdout=log, stderr=subprocess.STDOUT,
+                                    stdin=subprocess.DEVNULL, env=env,
+                                    preexec_fn=lambda slot=slot: os.sched_setaffinity(0, slot))
+            running[proc] = (name, config, slot, log, time.time())
+            print(" [Sweep] started {} on cores {}".format(name, slot))
+
+        time.sleep(1)
+        for proc in [p for p in running if p.poll() is not None]:
+            name, config, slot, log, start = running.pop(proc)
+            log.close()
+            free.append(slot)
+            row = dict(name=name, returncode=proc.returncode, wall_seconds=time.time() - start)
+            row.update(config)
+            summary = os.path.join(args.output, name, "summary.json")
+            if proc.returncode == 0 and os.path.exists(summary):
+                with open(summary) as f:
+                    row.update(json.load(f))
+            results.append(row)
+            print(" [Sweep] finished {} (exit {}) in {:.0f}s".format(name, proc.returncode, row["wall_seconds"]))
+
+    columns = []
+    for row in results:
+        columns += [c for c in row if c not in columns]
+    with open(os.path.join(args.output, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+    print(" [Sweep] results in {}".format(os.path.join(args.output, "results.csv")))
+
+
+if __name__ == "__main__":
+    main()
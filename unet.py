@@ -1,17 +1,49 @@
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
+
+CHECKPOINT_MODES = ("none", "center", "all")
+NORM_MODES = ("batch", "sync", "group")
+GROUPS = 32
+
+def _norm_layer(norm, channels, momentum):
+    # GroupNorm statistics do not depend on the batch, so tiny micro-batches
+    # (gradient accumulation) normalize as well as large ones
+    if norm == "group":
+        return nn.GroupNorm(min(GROUPS, channels), channels)
+    if norm == "sync":
+        return nn.SyncBatchNorm(channels, momentum=momentum)
+    return nn.BatchNorm2d(channels, momentum=momentum)
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # momentum 0 leaves the running statistics untouched, so recomputing a
+    # checkpointed block does not count its batch twice
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None) for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(bns, saved):
+            m.momentum = momentum
+            if tracked is not None:
+                m.num_batches_tracked.copy_(tracked)
 
 class ConvBnRelu(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, padding, stride, momentum=0.1, 
-                 radius=False):
+                 radius=False, norm="batch"):
         super(ConvBnRelu, self).__init__()
 
         
         self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size,
                                 padding=padding, stride=stride)
 
-        self.bn = nn.BatchNorm2d(out_channels, momentum=momentum)
+        self.bn = _norm_layer(norm, out_channels, momentum)
         self.relu = nn.ReLU()
 
     def forward(self, x):
@@ -20,13 +52,20 @@ class ConvBnRelu(nn.Module):
         x = self.relu(x)
         return x
 
+    def fuse(self):
+        """Folds the (eval-mode) BatchNorm statistics into the conv weights; GroupNorm is left as is."""
+        if isinstance(self.bn, nn.modules.batchnorm._BatchNorm):
+            self.conv = fuse_conv_bn_eval(self.conv, self.bn)
+            self.bn = nn.Identity()
+        return self
+
 class StackEncoder(nn.Module):
-    def __init__(self, in_channels, out_channels, padding, momentum=0.5, radius=False):
+    def __init__(self, in_channels, out_channels, padding, momentum=0.5, radius=False, norm="batch"):
         super(StackEncoder, self).__init__()
         self.convr1 = ConvBnRelu(in_channels, out_channels, kernel_size=(3, 3),
-                                 stride=1, padding=padding, momentum=momentum, radius=radius)
+                                 stride=1, padding=padding, momentum=momentum, radius=radius, norm=norm)
         self.convr2 = ConvBnRelu(out_channels, out_channels, kernel_size=(3, 3),
-                                 stride=1, padding=padding, momentum=momentum)
+                                 stride=1, padding=padding, momentum=momentum, norm=norm)
         self.maxPool = nn.MaxPool2d(kernel_size=(2, 2), stride=2)
 
     def forward(self, x):
@@ -37,7 +76,7 @@ class StackEncoder(nn.Module):
         return x, x_trace
 
 class StackDecoder(nn.Module):
-    def __init__(self, in_channels, out_channels, padding, momentum=0.5, radius=False):
+    def __init__(self, in_channels, out_channels, padding, momentum=0.5, radius=False, norm="batch"):
         super(StackDecoder, self).__init__()
 
         # self.upSample = nn.Upsample(size=upsample_size, scale_factor=(2,2), mode='bilinear')
@@ -45,13 +84,16 @@ class StackDecoder(nn.Module):
         self.transpose_conv = nn.ConvTranspose2d(in_channels, out_channels, kernel_size=(2, 2), stride=2)
 
         self.convr1 = ConvBnRelu(in_channels, out_channels, kernel_size=(3, 3), stride=1, padding=padding,
-                                 momentum=momentum, radius=radius)
+                                 momentum=momentum, radius=radius, norm=norm)
         self.convr2 = ConvBnRelu(out_channels, out_channels, kernel_size=(3, 3), stride=1, padding=padding,
-                                 momentum=momentum)
+                                 momentum=momentum, norm=norm)
 
     def _crop_concat(self, upsampled, bypass):
 
         margin = bypass.size()[2] - upsampled.size()[2]
+        if margin == 0:
+            # padding=1 keeps the shapes equal, no crop needed
+            return torch.cat((upsampled, bypass), 1)
         c = margin // 2
         if margin % 2 == 1:
             bypass = F.pad(bypass, (-c, -c - 1, -c, -c - 1))
@@ -68,29 +110,92 @@ class StackDecoder(nn.Module):
         return x
 
 class Unet2D(nn.Module):
-    
-    def __init__(self, in_shape, padding, momentum, num_classes):
+    """
+      :param checkpoint: activation checkpointing during training, "none",
+        "center" (the two center blocks) or "all" (every encoder/decoder stack
+        and the center). Checkpointed blocks keep only their inputs for
+        backward and recompute the rest, trading compute for memory.
+      :param norm: normalization after every conv, "batch" (BatchNorm2d),
+        "sync" (SyncBatchNorm, statistics over all distributed processes; CUDA
+        only when a process group is running) or "group" (GroupNorm with 32
+        groups, independent of the batch size).
+      """
+    def __init__(self, in_shape, padding, momentum, num_classes, checkpoint="none", norm="batch"):
         super(Unet2D, self).__init__()
         channels, heights, width = in_shape
         self.padding = padding
+        if checkpoint not in CHECKPOINT_MODES:
+            raise ValueError("checkpoint must be one of {}, got {}".format(CHECKPOINT_MODES, checkpoint))
+        self.checkpoint = checkpoint
+        if norm not in NORM_MODES:
+            raise ValueError("norm must be one of {}, got {}".format(NORM_MODES, norm))
 
-        self.down1 = StackEncoder(channels, 64, padding, momentum=momentum)
-        self.down2 = StackEncoder(64, 128, padding, momentum=momentum)
-        self.down3 = StackEncoder(128, 256, padding, momentum=momentum)
-        self.down4 = StackEncoder(256, 512, padding, momentum=momentum)
+        self.down1 = StackEncoder(channels, 64, padding, momentum=momentum, norm=norm)
+        self.down2 = StackEncoder(64, 128, padding, momentum=momentum, norm=norm)
+        self.down3 = StackEncoder(128, 256, padding, momentum=momentum, norm=norm)
+        self.down4 = StackEncoder(256, 512, padding, momentum=momentum, norm=norm)
 
-        self.center1 = ConvBnRelu(512, 1024, kernel_size=(3, 3), stride=1, padding=padding, momentum=momentum)
-        self.center2 = ConvBnRelu(1024, 1024, kernel_size=(3, 3), stride=1, padding=padding, momentum=momentum)
+        self.center1 = ConvBnRelu(512, 1024, kernel_size=(3, 3), stride=1, padding=padding, momentum=momentum, norm=norm)
+        self.center2 = ConvBnRelu(1024, 1024, kernel_size=(3, 3), stride=1, padding=padding, momentum=momentum, norm=norm)
 
-        self.up1 = StackDecoder(in_channels=1024, out_channels=512, padding=padding, momentum=momentum)
-        self.up2 = StackDecoder(in_channels=512, out_channels=256, padding=padding, momentum=momentum)
-        self.up3 = StackDecoder(in_channels=256, out_channels=128, padding=padding, momentum=momentum)
-        self.up4 = StackDecoder(in_channels=128, out_channels=64, padding=padding, momentum=momentum)
+        self.up1 = StackDecoder(in_channels=1024, out_channels=512, padding=padding, momentum=momentum, norm=norm)
+        self.up2 = StackDecoder(in_channels=512, out_channels=256, padding=padding, momentum=momentum, norm=norm)
+        self.up3 = StackDecoder(in_channels=256, out_channels=128, padding=padding, momentum=momentum, norm=norm)
+        self.up4 = StackDecoder(in_channels=128, out_channels=64, padding=padding, momentum=momentum, norm=norm)
 
         self.output_seg_map = nn.Conv2d(64, num_classes, kernel_size=(1, 1), padding=0, stride=1)
         self.output_up_seg_map = nn.Upsample(size=(heights, width), mode='nearest')
 
+    def _center(self, x):
+        return self.center2(self.center1(x))
+
+    def _checkpointed(self, fn, *inputs):
+        calls = [0]
+
+        def run(*args):
+            calls[0] += 1
+            if calls[0] == 1:
+                return fn(*args)
+            with _frozen_bn_stats(self):
+                return fn(*args)
+        return checkpoint(run, *inputs, use_reentrant=False)
+
+    @torch.jit.unused
+    def _forward_checkpointed(self, x):
+        stacks = self.checkpoint == "all"
+        if stacks:
+            x, x_trace1 = self._checkpointed(self.down1, x)
+            x, x_trace2 = self._checkpointed(self.down2, x)
+            x, x_trace3 = self._checkpointed(self.down3, x)
+            x, x_trace4 = self._checkpointed(self.down4, x)
+        else:
+            x, x_trace1 = self.down1(x)
+            x, x_trace2 = self.down2(x)
+            x, x_trace3 = self.down3(x)
+            x, x_trace4 = self.down4(x)
+
+        x = self._checkpointed(self._center, x)
+
+        if stacks:
+            x = self._checkpointed(self.up1, x, x_trace4)
+            x = self._checkpointed(self.up2, x, x_trace3)
+            x = self._checkpointed(self.up3, x, x_trace2)
+            x = self._checkpointed(self.up4, x, x_trace1)
+        else:
+            x = self.up1(x, x_trace4)
+            x = self.up2(x, x_trace3)
+            x = self.up3(x, x_trace2)
+            x = self.up4(x, x_trace1)
+        return x
+
     def forward(self, x):
+        if self.checkpoint != "none" and self.training and torch.is_grad_enabled():
+            x = self._forward_checkpointed(x)
+            out = self.output_seg_map(x)
+            if self.padding == 0:
+                out = self.output_up_seg_map(out)
+            return out
+
         x, x_trace1 = self.down1(x)
         x, x_trace2 = self.down2(x)
         x, x_trace3 = self.down3(x)
@@ -111,5 +216,26 @@ class Unet2D(nn.Module):
 
         return out
 
+def optimize_for_inference(model, channels_last=True, script=False):
+    """
+      Prepares a trained Unet2D for serving: switches to eval mode, folds every
+      BatchNorm into the preceding conv and optionally moves the weights to
+      channels_last (feed inputs with x.to(memory_format=torch.channels_last)).
+      With script=True the model is TorchScript-compiled and frozen.
+      The model is modified in place; nn.DataParallel wrappers are unwrapped.
+      :returns: the optimized module
+      """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model.eval()
+    for m in model.modules():
+        if isinstance(m, ConvBnRelu):
+            m.fuse()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if script:
+        model = torch.jit.freeze(torch.jit.script(model))
+    return model
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
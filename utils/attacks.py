@@ -0,0 +1,207 @@
+import contextlib
+import torch
+import numpy as np
+from utils import optimize_linear
+
+
+@contextlib.contextmanager
+def frozen_parameters(model):
+    """Turns off requires_grad on every parameter so backward only produces input gradients."""
+    params = list(model.parameters())
+    flags = [p.requires_grad for p in params]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield model
+    finally:
+        for p, flag in zip(params, flags):
+            p.requires_grad_(flag)
+
+
+def _gradient_and_logits(model, x, y, loss_fn):
+    x = x.detach().requires_grad_(True)
+    with frozen_parameters(model):
+        logits = model(x)
+        loss = loss_fn(logits, y)
+        grad, = torch.autograd.grad(loss, x)
+    return grad, logits.detach(), loss.detach()
+
+
+def input_gradient(model, x, y, loss_fn):
+    """
+      Gradient of loss_fn(model(x), y) with respect to x only.
+      The model is used as is (callers put it in eval mode); parameter
+      gradients are neither computed nor accumulated.
+      :returns: (grad, loss) with loss detached
+      """
+    grad, _, loss = _gradient_and_logits(model, x, y, loss_fn)
+    return grad, loss
+
+
+def fgsm(model, x, y, loss_fn, eps=0.25, norm=np.inf, clip_min=None, clip_max=None):
+    """
+      Fast gradient method for one or several perturbation sizes.
+      The clean input gradient is computed once and every epsilon reuses it,
+      so evaluating k epsilons costs one backward pass instead of k.
+      :param eps: float or list of floats
+      :returns: generator of (eps, adversarial batch) pairs
+      """
+    eps_list = eps if isinstance(eps, (list, tuple)) else [eps]
+    grad, _ = input_gradient(model, x, y, loss_fn)
+    direction = optimize_linear(grad, 1.0, norm)
+    del grad
+
+    x = x.detach()
+    for e in eps_list:
+        adv_x = x + e * direction
+        if clip_min is not None or clip_max is not None:
+            adv_x.clamp_(clip_min, clip_max)
+        yield e, adv_x
+
+
+def clip_eta(eta, norm, eps):
+    """
+      Projects the perturbation eta onto the norm ball of radius eps, in place.
+      :param eta: Tensor, shape (N, d_1, ...). Batch of perturbations
+      :param norm: np.inf, 1, or 2. Order of norm constraint.
+      """
+    if norm == np.inf:
+        return eta.clamp_(-eps, eps)
+
+    red_ind = list(range(1, eta.dim()))
+    avoid_zero_div = torch.tensor(1e-12, dtype=eta.dtype, device=eta.device)
+    if norm == 1:
+        norm_value = torch.max(avoid_zero_div, eta.abs().sum(red_ind, keepdim=True))
+    elif norm == 2:
+        norm_value = torch.sqrt(torch.max(avoid_zero_div, (eta ** 2).sum(red_ind, keepdim=True)))
+    else:
+        raise NotImplementedError("Only L-inf, L1 and L2 norms are currently implemented.")
+    # scale down only the perturbations that leave the ball
+    return eta.mul_(torch.clamp(eps / norm_value, max=1.))
+
+
+def random_init(x, norm, eps):
+    """Random starting perturbation inside the eps-ball: uniform for L-inf, a random direction with uniform radius otherwise."""
+    if norm == np.inf:
+        return torch.empty_like(x).uniform_(-eps, eps)
+    red_ind = list(range(1, x.dim()))
+    direction = torch.randn_like(x)
+    if norm == 1:
+        direction.div_(direction.abs().sum(red_ind, keepdim=True).clamp(min=1e-12))
+    elif norm == 2:
+        direction.div_(direction.pow(2).sum(red_ind, keepdim=True).sqrt().clamp(min=1e-12))
+    else:
+        raise NotImplementedError("Only L-inf, L1 and L2 norms are currently implemented.")
+    radius = torch.rand((x.size(0),) + (1,) * (x.dim() - 1), dtype=x.dtype, device=x.device)
+    return direction.mul_(radius * eps)
+
+
+def pgd(model, x, y, loss_fn, eps=0.25, eps_iter=0.01, nb_iter=10, norm=np.inf, rand_init=True,
+        clip_min=None, clip_max=None, success_fn=None):
+    """
+      Projected gradient descent (Madry et al.) on a whole batch.
+      Every iteration steps along optimize_linear(grad, eps_iter, norm) and
+      projects back onto the eps-ball around x; with rand_init=False this is
+      the basic iterative method. The batch is updated in place.
+      :param success_fn: optional callable(logits, y, index) -> bool Tensor,
+        one entry per row of logits; index holds the batch positions of those
+        rows, None while the whole batch is active. Samples for which it is
+        True are frozen and dropped from later forward/backward passes
+        (per-sample early stopping).
+      :returns: Tensor, shape of x. Adversarial batch
+      """
+    x = x.detach()
+    if rand_init:
+        eta = clip_eta(random_init(x, norm, eps), norm, eps)
+    else:
+        eta = torch.zeros_like(x)
+    adv_x = x + eta
+    if clip_min is not None or clip_max is not None:
+        adv_x.clamp_(clip_min, clip_max)
+
+    active = None
+    for _ in range(nb_iter):
+        if active is None:
+            x_a, y_a, adv_a, eta_a = x, y, adv_x, eta
+        else:
+            x_a, y_a, adv_a = x[active], y[active], adv_x[active]
+            eta_a = torch.empty_like(adv_a)
+
+        grad, logits, _ = _gradient_and_logits(model, adv_a, y_a, loss_fn)
+
+        if success_fn is not None:
+            done = success_fn(logits, y_a, active)
+            if bool(done.all()):
+                break
+            if bool(done.any()):
+                keep = (~done).nonzero().squeeze(1)
+                active = keep if active is None else active[keep]
+                x_a, y_a, adv_a, grad = x_a[keep], y_a[keep], adv_a[keep], grad[keep]
+                eta_a = torch.empty_like(adv_a)
+
+        adv_a.add_(optimize_linear(grad, eps_iter, norm))
+        torch.sub(adv_a, x_a, out=eta_a)
+        clip_eta(eta_a, norm, eps)
+        torch.add(x_a, eta_a, out=adv_a)
+        if clip_min is not None or clip_max is not None:
+            adv_a.clamp_(clip_min, clip_max)
+
+        if active is not None:
+            adv_x.index_copy_(0, active, adv_a)
+
+    return adv_x
+
+
+def bim(model, x, y, loss_fn, eps=0.25, eps_iter=0.01, nb_iter=10, norm=np.inf, **kwargs):
+    """Basic iterative method (Kurakin et al.): PGD without the random start."""
+    return pgd(model, x, y, loss_fn, eps=eps, eps_iter=eps_iter, nb_iter=nb_iter, norm=norm,
+               rand_init=False, **kwargs)
+
+
+def multilabel_flipped(clean_logits, y):
+    """
+      Early-stopping criterion for multi-label classifiers, relative to the
+      clean prediction: a sample is done once every label decision it got
+      right on the clean input is wrong. A single wrong label is not enough,
+      most clean samples already have one. Samples without a correct label
+      are never done.
+      :param clean_logits: Tensor, shape (N, C). Logits of the clean batch
+      :param y: Tensor, shape (N, C). Binary targets
+      :returns: callable(logits, y, index) for pgd's success_fn
+      """
+    correct = (clean_logits.detach() > 0) == (y > 0.5)
+
+    def done(logits, y, index):
+        clean = correct if index is None else correct[index]
+        flipped = (logits > 0) != (y > 0.5)
+        return (flipped | ~clean).flatten(1).all(1) & clean.flatten(1).any(1)
+    return done
+
+
+def attack_sweep(attack, model, x, y, loss_fn, eps, norm=np.inf, **kwargs):
+    """
+      Runs `attack` ("fgsm", "pgd" or "bim") for every perturbation size in eps.
+      FGSM shares one input gradient across all sizes; the iterative attacks
+      run once per size. Extra keyword arguments go to pgd/bim.
+      :returns: generator of (eps, adversarial batch) pairs
+      """
+    eps_list = eps if isinstance(eps, (list, tuple)) else [eps]
+    if attack == "fgsm":
+        return fgsm(model, x, y, loss_fn, eps=eps_list, norm=norm)
+    if attack == "pgd":
+        fn = pgd
+    elif attack == "bim":
+        fn = bim
+    else:
+        raise NotImplementedError("Unknown attack {}".format(attack))
+    return ((e, fn(model, x, y, loss_fn, eps=e, norm=norm, **kwargs)) for e in eps_list)
+
+
+def free_step(delta, grad, eps, norm=np.inf):
+    """
+      Perturbation update of "free" adversarial training (Shafahi et al.).
+      Ascends delta along the input gradient that the weight update's backward
+      pass already produced and projects it back onto the eps-ball, in place.
+      """
+    delta.add_(optimize_linear(grad, eps, norm))
+    return clip_eta(delta, norm, eps)
@@ -0,0 +1,135 @@
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+from torch import nn
+
+
+def _snapshot(obj):
+    # detached CPU copies, so training can keep mutating the live tensors
+    # while the background thread serializes
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), random=random.getstate())
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    # the setters only take CPU ByteTensors, whatever map_location did
+    torch.set_rng_state(state["torch"].cpu())
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def unwrap(model):
+    return model.module if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else model
+
+
+class CheckpointManager(object):
+    """Periodic training checkpoints with retention and resume.
+
+    Every `interval` epochs the model, optimizer, RNG states, epoch and any
+    extra state are snapshotted to CPU on the calling thread and written by a
+    background thread, first to a temporary file and then renamed, so a job
+    killed mid-save never leaves a truncated checkpoint. At most one save is in
+    flight; only the newest `keep` checkpoints are kept (keep=0 keeps all).
+    Model weights are stored without the nn.DataParallel "module." prefix.
+    `generators` maps names to torch.Generator-like objects (get_state and
+    set_state) whose streams, e.g. the sampler's, are saved and restored too.
+    """
+
+    PATTERN = re.compile(r"^epoch-(\d+)\.pth$")
+
+    def __init__(self, directory, interval=1, keep=3, generators=None):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.generators = generators or {}
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, epoch):
+        return os.path.join(self.directory, "epoch-{:04d}.pth".format(epoch))
+
+    def checkpoints(self):
+        """(epoch, path) of the checkpoints on disk, oldest first."""
+        found = []
+        for name in os.listdir(self.directory):
+            match = self.PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self):
+        found = self.checkpoints()
+        return found[-1][1] if found else None
+
+    def due(self, epoch, last_epoch=None):
+        return (epoch + 1) % self.interval == 0 or epoch == last_epoch
+
+    def save(self, epoch, model, optimizer, force=False, last_epoch=None, **extra):
+        """Schedules a checkpoint of `epoch` when it is due (or force=True); returns whether one was scheduled."""
+        if not (force or self.due(epoch, last_epoch)):
+            return False
+        self.wait()
+        state = _snapshot(dict(epoch=epoch, model=unwrap(model).state_dict(),
+                               optimizer=optimizer.state_dict(), extra=extra))
+        state["rng"] = rng_state()
+        state["generators"] = {name: _snapshot(g.get_state()) for name, g in self.generators.items()}
+        self._thread = threading.Thread(target=self._write, args=(state, self.path(epoch)), daemon=False)
+        self._thread.start()
+        return True
+
+    def _write(self, state, path):
+        tmp = path + ".tmp"
+        try:
+            torch.save(state, tmp)
+            os.replace(tmp, path)
+            if self.keep > 0:
+                for _, old in self.checkpoints()[:-self.keep]:
+                    os.remove(old)
+        except Exception as e:
+            self._error = e
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def wait(self):
+        """Blocks until the pending save is on disk; re-raises its error, if any."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def load(self, path, model, optimizer=None, map_location="cpu"):
+        """
+          Restores model, optimizer, RNG and generator states from a checkpoint.
+          The default CPU map_location is enough for any device: load_state_dict
+          copies the tensors onto the parameters' devices.
+          :returns: (epoch the checkpoint was taken after, extra dict)
+          """
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        unwrap(model).load_state_dict(state["model"])
+        if optimizer is not None:
+            optimizer.load_state_dict(state["optimizer"])
+        set_rng_state(state["rng"])
+        for name, saved in state.get("generators", {}).items():
+            if name in self.generators and saved is not None:
+                self.generators[name].set_state(saved.cpu())
+        return state["epoch"], state["extra"]
@@ -0,0 +1,75 @@
+import os
+import builtins
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend="gloo"):
+    """
+      Joins the process group described by the torchrun environment
+      (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+      Processes other than rank 0 stop printing, so console output comes
+      from one process only; print(..., force=True) still gets through.
+      With nccl every process first binds to its GPU, cuda:LOCAL_RANK.
+      :returns: (rank, world_size, local_rank), (0, 1, 0) outside torchrun
+      """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return 0, 1, 0
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if backend == "nccl":
+        # otherwise every rank's barriers and collectives run on cuda:0
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend=backend, init_method="env://")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if rank != 0:
+        builtin_print = builtins.print
+
+        def print(*args, **kwargs):
+            if kwargs.pop("force", False):
+                builtin_print(*args, **kwargs)
+        builtins.print = print
+    return rank, world_size, local_rank
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def _collective_device():
+    # nccl only reduces CUDA tensors, gloo takes CPU ones
+    if is_distributed() and dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def all_reduce_mean(value):
+    """Mean of a python number or tensor over all processes, as a float."""
+    if torch.is_tensor(value):
+        value = value.detach()
+    tensor = torch.as_tensor(value, dtype=torch.float64).to(_collective_device(), copy=True)
+    if is_distributed():
+        dist.all_reduce(tensor)
+        tensor /= get_world_size()
+    return float(tensor)
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
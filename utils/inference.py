@@ -0,0 +1,89 @@
+import torch
+
+
+def tile_origins(length, tile, stride):
+    """Start offsets of tiles of size `tile` every `stride` pixels; the last tile is aligned to the end."""
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, stride))
+    origins.append(length - tile)
+    return origins
+
+
+def blend_window(tile, overlap, device=None):
+    """
+      (tile, tile) weights for blending overlapping tiles: a linear ramp over
+      `overlap` pixels at every edge and 1 in the interior. Weights stay
+      strictly positive, so border pixels covered by one tile keep its logits.
+      """
+    pos = torch.arange(tile, dtype=torch.float32, device=device)
+    ramp = torch.min(pos + 1, tile - pos) / (overlap + 1)
+    ramp = ramp.clamp_(max=1.)
+    return ramp[:, None] * ramp[None, :]
+
+
+def tiled_predict(model, image, num_classes, tile=256, overlap=64, batch_size=4, labels=False):
+    """
+      Full-resolution segmentation of an arbitrarily sized image with a
+      fixed-size network.
+      The image is split into tiles of `tile` pixels overlapping by `overlap`,
+      tiles are pushed through the model `batch_size` at a time and their
+      logits are blended with `blend_window`. Tiles are processed one row at a
+      time and the accumulator only spans one row of tiles, so memory is
+      bounded by batch_size * tile^2 for the forward pass plus
+      num_classes * tile * W for blending, whatever the image height.
+      Images smaller than a tile are zero padded (zero is the dataset mean
+      after normalization).
+      :param image: Tensor, shape (3, H, W). Normalized image, on any device
+      :param labels: return the (H, W) uint8 argmax map instead of the logits
+      :returns: Tensor on the CPU, (num_classes, H, W) float32 logits or (H, W) uint8 labels
+      """
+    if overlap >= tile:
+        raise ValueError("overlap ({}) must be smaller than tile ({})".format(overlap, tile))
+    device = next(model.parameters()).device
+    _, height, width = image.shape
+    pad_h, pad_w = max(tile - height, 0), max(tile - width, 0)
+    if pad_h or pad_w:
+        image = torch.nn.functional.pad(image, (0, pad_w, 0, pad_h))
+    full_h, full_w = height + pad_h, width + pad_w
+
+    stride = tile - overlap
+    rows = tile_origins(full_h, tile, stride)
+    cols = tile_origins(full_w, tile, stride)
+    window = blend_window(tile, overlap, device=device)
+
+    if labels:
+        out = torch.empty((height, width), dtype=torch.uint8)
+    else:
+        out = torch.empty((num_classes, height, width), dtype=torch.float32)
+    # rolling accumulator for one row of tiles; rows above the next tile row
+    # are final and get flushed to `out`
+    acc = torch.zeros((num_classes, tile, full_w), dtype=torch.float32, device=device)
+    weight = torch.zeros((tile, full_w), dtype=torch.float32, device=device)
+
+    with torch.no_grad():
+        for r, y in enumerate(rows):
+            for start in range(0, len(cols), batch_size):
+                xs = cols[start:start + batch_size]
+                batch = torch.stack([image[:, y:y + tile, x:x + tile] for x in xs]).to(device, non_blocking=True)
+                logits = model(batch).float()
+                if logits.shape[-2:] != (tile, tile):
+                    raise ValueError("model output {} does not match the tile size {}".format(tuple(logits.shape[-2:]), tile))
+                for x, tile_logits in zip(xs, logits):
+                    acc[:, :, x:x + tile].addcmul_(tile_logits, window)
+                    weight[:, x:x + tile].add_(window)
+
+            done = rows[r + 1] - y if r + 1 < len(rows) else tile
+            top, bottom = y, min(y + done, height)
+            if bottom > top:
+                blended = acc[:, :bottom - top, :width] / weight[:bottom - top, :width]
+                if labels:
+                    out[top:bottom] = blended.argmax(0).to("cpu", torch.uint8)
+                else:
+                    out[:, top:bottom] = blended.cpu()
+            # shift the rows still waiting for the next tile row to the top
+            acc[:, :tile - done] = acc[:, done:].clone()
+            acc[:, tile - done:] = 0
+            weight[:tile - done] = weight[done:].clone()
+            weight[tile - done:] = 0
+    return out
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import numpy as np
+import torch
+
+
+def _plain(value):
+    # JSON-friendly scalars and lists from tensors / numpy values
+    if torch.is_tensor(value):
+        value = value.detach().cpu()
+        return _plain(value.item() if value.dim() == 0 else value.tolist())
+    if isinstance(value, (np.ndarray, np.generic)):
+        return _plain(value.tolist())
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, float) and value in (float("inf"), float("-inf")):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+class MetricsLogger(object):
+    """Buffered, append-only JSON-lines metrics log with rate-limited console output.
+
+    Every `log` call adds one record (wall time, kind and the given fields) to
+    an in-memory buffer that is appended to `path` every `flush_every` records
+    or `flush_seconds` seconds, whichever comes first, so the file can be
+    followed live (e.g. `tail -f`) and a crash loses at most one buffer.
+    Fields are converted when the buffer is written, so tensor values (e.g. a
+    detached batch loss) are read off the device once per flush, not per call.
+    A disabled logger (e.g. on non-zero distributed ranks) drops everything.
+    NaN becomes null (per-class IoU of absent classes) and infinities become
+    strings, so every line stays valid JSON.
+    """
+
+    def __init__(self, path, flush_every=50, flush_seconds=10., print_seconds=10., enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.print_seconds = print_seconds
+        self.buffer = []
+        self.last_flush = time.time()
+        self.last_print = None
+        directory = os.path.dirname(path)
+        if directory and enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def log(self, kind, **fields):
+        if not self.enabled:
+            return
+        record = dict(time=time.time(), kind=kind)
+        record.update(fields)
+        self.buffer.append(record)
+        if len(self.buffer) >= self.flush_every or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def console(self, message, force=False):
+        """Prints message unless another one was printed less than print_seconds ago (force always prints).
+
+        message may also be a callable returning the line, so it is only formatted when printed.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        if force or self.last_print is None or now - self.last_print >= self.print_seconds:
+            print(message() if callable(message) else message)
+            self.last_print = now
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(_plain(record)) + "\n" for record in self.buffer))
+            self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
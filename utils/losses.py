@@ -86,7 +86,7 @@ def flatten(tensor):
     # Transpose: (N, C, D, H, W) -> (C, N, D, H, W)
     transposed = tensor.permute(axis_order)
     # Flatten: (C, N, D, H, W) -> (C, N * D * H * W)
-    return transposed.view(C, -1)
+    return transposed.reshape(C, -1)
 
 import torch
 from torch.nn.modules.loss import _WeightedLoss
@@ -0,0 +1,238 @@
+import torch
+import torch.distributed as dist
+import numpy as np
+
+
+class ConfusionMatrix(object):
+    """Streaming confusion matrix for semantic segmentation.
+
+    Counts are kept on the device of the predictions and updated with a single
+    index_add_ into a fixed-size flat buffer per batch, so nothing is copied to
+    the host until the epoch-level scores are read (bincount would read the
+    maximum index back to size its output). Rows are ground truth, columns are predictions; target
+    pixels outside [0, num_classes) (e.g. the VOC 255 boundary) are ignored.
+    """
+
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        self.device = device
+        self.mat = None
+        if device is not None:
+            self.reset()
+
+    def reset(self):
+        n = self.num_classes
+        # the extra last bin collects ignored pixels; mat is a view of the rest
+        self.counts = torch.zeros(n * n + 1, dtype=torch.int64, device=self.device)
+        self.mat = self.counts[:n * n].view(n, n)
+        self.ones = None
+
+    def update(self, pred, target):
+        """
+        :param pred: Tensor, (N, H, W) class indices or (N, C, H, W) logits
+        :param target: Tensor, (N, H, W) class indices, on any device
+        """
+        if pred.dim() == target.dim() + 1:
+            pred = pred.argmax(dim=1)
+        if self.mat is None:
+            self.device = pred.device
+            self.reset()
+
+        n = self.num_classes
+        pred = pred.reshape(-1).to(self.device, torch.int64)
+        target = target.reshape(-1).to(self.device, torch.int64, non_blocking=True)
+
+        # ignored pixels go to an overflow bin instead of being masked out,
+        # which would force a device sync on the boolean index
+        valid = (target >= 0) & (target < n)
+        index = torch.where(valid, target * n + pred, torch.full_like(target, n * n))
+        if self.ones is None or self.ones.numel() < index.numel():
+            self.ones = torch.ones(index.numel(), dtype=torch.int64, device=self.device)
+        self.counts.index_add_(0, index, self.ones[:index.numel()])
+
+    def all_reduce(self):
+        """Sums the counts of every process (torch.distributed), so all ranks score the whole split."""
+        if self.mat is None:
+            self.reset()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.mat)
+        return self
+
+    def iou(self):
+        """Per-class IoU as a numpy array; nan for classes absent from both prediction and target."""
+        mat = self.mat.double()
+        tp = mat.diag()
+        union = mat.sum(0) + mat.sum(1) - tp
+        iou = tp / union
+        return iou.cpu().numpy()
+
+    def mean_iou(self):
+        iou = self.iou()
+        if np.isnan(iou).all():
+            return float("nan")
+        return float(np.nanmean(iou))
+
+    def pixel_accuracy(self):
+        mat = self.mat.double()
+        return float(mat.diag().sum() / mat.sum().clamp(min=1))
+
+
+def average_precision(scores, targets):
+    """
+      Per-class average precision, vectorized over classes.
+      Matches sklearn.metrics.average_precision_score(average=None): tied scores
+      share one threshold and classes without positives score 0.
+      :param scores: Tensor, shape (N, C). Predicted scores
+      :param targets: Tensor, shape (N, C). Binary ground truth
+      :returns: Tensor, shape (C,). Average precision per class
+      """
+    n = scores.size(0)
+    order = scores.argsort(dim=0, descending=True)
+    scores = scores.gather(0, order)
+    targets = (targets.gather(0, order) > 0.5).double()
+    tp = targets.cumsum(0)
+
+    # every sample is scored with the precision at the last row of its run of
+    # tied scores, found with a reversed running minimum over run end indices
+    rows = torch.arange(n, device=scores.device).unsqueeze(1).expand_as(scores)
+    last = torch.ones_like(scores, dtype=torch.bool)
+    last[:-1] = scores[:-1] != scores[1:]
+    end = torch.where(last, rows, torch.full_like(rows, n - 1))
+    end = end.flip(0).cummin(0).values.flip(0)
+    precision = tp.gather(0, end) / (end + 1).double()
+
+    num_pos = targets.sum(0)
+    return (targets * precision).sum(0) / num_pos.clamp(min=1)
+
+
+class ScoreCollector(object):
+    """Epoch-level buffer of multi-label scores and targets.
+
+    Storage for `num_samples` rows is allocated once, on the device of the
+    first batch, and filled in place; mAP is computed with `average_precision`.
+    """
+
+    def __init__(self, num_samples, num_classes, device=None):
+        self.num_samples = num_samples
+        self.num_classes = num_classes
+        self.device = device
+        self.scores = None
+        self.targets = None
+        self.count = 0
+        if device is not None:
+            self.reset()
+
+    def reset(self):
+        self.scores = torch.empty((self.num_samples, self.num_classes), dtype=torch.float32, device=self.device)
+        self.targets = torch.empty((self.num_samples, self.num_classes), dtype=torch.float32, device=self.device)
+        self.count = 0
+
+    def update(self, scores, targets):
+        if self.scores is None:
+            self.device = scores.device
+            self.reset()
+        end = self.count + scores.size(0)
+        if end > self.num_samples:
+            raise IndexError("ScoreCollector holds {} samples, got {}".format(self.num_samples, end))
+        self.scores[self.count:end].copy_(scores.detach())
+        self.targets[self.count:end].copy_(targets, non_blocking=True)
+        self.count = end
+
+    def all_gather(self):
+        """
+          Replaces the local rows with the rows of every process
+          (torch.distributed), so all ranks score the whole split. Ranks may hold
+          different numbers of rows.
+          """
+        if not (dist.is_available() and dist.is_initialized()):
+            return self
+        if self.scores is None:
+            self.reset()
+        world_size = dist.get_world_size()
+        count = torch.tensor([self.count], dtype=torch.int64, device=self.scores.device)
+        counts = [torch.zeros_like(count) for _ in range(world_size)]
+        dist.all_gather(counts, count)
+        counts = [int(c) for c in counts]
+        longest = max(counts)
+
+        gathered = []
+        for local in (self.scores, self.targets):
+            padded = local.new_zeros((longest, self.num_classes))
+            padded[:self.count] = local[:self.count]
+            parts = [torch.empty_like(padded) for _ in range(world_size)]
+            dist.all_gather(parts, padded)
+            gathered.append(torch.cat([part[:c] for part, c in zip(parts, counts)]))
+        self.scores, self.targets = gathered
+        self.count = self.num_samples = sum(counts)
+        return self
+
+    def average_precision(self):
+        return average_precision(self.scores[:self.count], self.targets[:self.count]).cpu().numpy()
+
+    def mean_average_precision(self):
+        return float(self.average_precision().mean())
+
+
+class RunningStat(object):
+    """Sum, count and exponential moving average of a stream of scalars, e.g. batch losses.
+
+    Values are detached and accumulated in place in two preallocated tensors on
+    their own device, so no autograd graph is kept alive and an update neither
+    allocates nor waits for the device. The host reads the accumulators back
+    (one sync) every `sync_every` updates, or when a statistic is requested.
+    """
+
+    def __init__(self, momentum=0.9, sync_every=50):
+        self.momentum = momentum
+        self.sync_every = sync_every
+        self.reset()
+
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+        self._ema = None
+        self._pending = None
+        self._pending_ema = None
+        self._unsynced = 0
+
+    def update(self, value, n=1):
+        """
+        :param value: Tensor or number, the (mean) value of one step
+        :param n: weight of the value in the sum and count
+        """
+        if not torch.is_tensor(value):
+            value = torch.tensor(float(value))
+        value = value.detach()
+        if self._pending is None:
+            self._pending = torch.zeros((), dtype=torch.float64, device=value.device)
+            self._pending_ema = torch.zeros((), dtype=torch.float64, device=value.device)
+        self._pending.add_(value, alpha=n)
+        if self.count == 0:
+            self._pending_ema.copy_(value)
+        else:
+            self._pending_ema.mul_(self.momentum).add_(value, alpha=1 - self.momentum)
+        self.count += n
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            self.total += self._pending.item()
+            self._pending.zero_()
+            self._ema = self._pending_ema.item()
+            self._unsynced = 0
+        return self
+
+    @property
+    def sum(self):
+        return self.sync().total
+
+    @property
+    def mean(self):
+        """Mean of the weighted values, nan before the first update."""
+        return self.sum / self.count if self.count else float("nan")
+
+    @property
+    def ema(self):
+        return self.sync()._ema if self.count else float("nan")
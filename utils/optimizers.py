@@ -3,15 +3,30 @@ import torch
 from torch.optim.optimizer import Optimizer, required
 
 
+def _master_weights(p, state):
+    # fp32 parameters are updated in place; lower precision parameters get a
+    # persistent fp32 master copy in the optimizer state, and the rounded
+    # result is written back after every step
+    if p.dtype == torch.float32:
+        return p.data
+    if 'master' not in state:
+        state['master'] = p.data.float()
+    return state['master']
+
+
 class RAdam(Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, foreach=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, foreach=foreach)
         self.buffer = [[None, None, None] for ind in range(10)]
         super(RAdam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
+        # also reached from load_state_dict, which replaces every state tensor
         super(RAdam, self).__setstate__(state)
+        self._foreach_cache = {}
+        for group in self.param_groups:
+            group.setdefault('foreach', False)
 
     def step(self, closure=None):
 
@@ -20,6 +35,9 @@ class RAdam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if group['foreach']:
+                self._step_foreach(group)
+                continue
 
             for p in group['params']:
                 if p.grad is None:
@@ -28,11 +46,10 @@ class RAdam(Optimizer):
                 if grad.is_sparse:
                     raise RuntimeError('RAdam does not support sparse gradients')
 
-                p_data_fp32 = p.data.float()
-
                 state = self.state[p]
+                p_data_fp32 = _master_weights(p, state)
 
-                if len(state) == 0:
+                if 'step' not in state:
                     state['step'] = 0
                     state['exp_avg'] = torch.zeros_like(p_data_fp32)
                     state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
@@ -43,8 +60,8 @@ class RAdam(Optimizer):
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
                 beta1, beta2 = group['betas']
 
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
 
                 state['step'] += 1
                 buffered = self.buffer[int(state['step'] % 10)]
@@ -67,44 +84,71 @@ class RAdam(Optimizer):
                     buffered[2] = step_size
 
                 if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
+                    p_data_fp32.add_(p_data_fp32, alpha=-group['weight_decay'] * group['lr'])
 
                 # more conservative since it's an approximated value
                 if N_sma >= 5:
                     denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
+                    p_data_fp32.addcdiv_(exp_avg, denom, value=-step_size)
                 else:
-                    p_data_fp32.add_(-step_size, exp_avg)
+                    p_data_fp32.add_(exp_avg, alpha=-step_size)
 
-                p.data.copy_(p_data_fp32)
+                if p.dtype != torch.float32:
+                    p.data.copy_(p_data_fp32)
 
         return loss
 
+    @torch.no_grad()
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
+        for step, masters, grads, exp_avgs, exp_avg_sqs, denoms, write_back in _foreach_buckets(self, group):
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+            # N_sma and the step size depend only on the step count, so they are
+            # computed once for the whole bucket
+            N_sma, step_size = _radam_step_size(group['lr'], beta1, beta2, step)
+
+            if group['weight_decay'] != 0:
+                torch._foreach_mul_(masters, 1 - group['weight_decay'] * group['lr'])
+
+            if N_sma >= 5:
+                torch._foreach_copy_(denoms, exp_avg_sqs)
+                torch._foreach_sqrt_(denoms)
+                torch._foreach_add_(denoms, group['eps'])
+                torch._foreach_addcdiv_(masters, exp_avgs, denoms, value=-step_size)
+            else:
+                torch._foreach_add_(masters, exp_avgs, alpha=-step_size)
+
+            _write_back(write_back)
+
 
 class AdamW(Optimizer):
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, use_variance=True, warmup=4000):
+                 weight_decay=0, use_variance=True, warmup=4000, foreach=False):
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, use_variance=True, warmup=warmup)
+                        weight_decay=weight_decay, use_variance=True, warmup=warmup, foreach=foreach)
         print('======== Warmup: {} ========='.format(warmup))
         super(AdamW, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(AdamW, self).__setstate__(state)
+        self._foreach_cache = {}
+        for group in self.param_groups:
+            group.setdefault('foreach', False)
 
     def step(self, closure=None):
-        global iter_idx
-        iter_idx += 1
-        grad_list = list()
-        mom_list = list()
-        mom_2rd_list = list()
-
         loss = None
         if closure is not None:
             loss = closure()
 
         for group in self.param_groups:
+            if group['foreach']:
+                self._step_foreach(group)
+                continue
 
             for p in group['params']:
                 if p.grad is None:
@@ -113,11 +157,10 @@ class AdamW(Optimizer):
                 if grad.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
 
-                p_data_fp32 = p.data.float()
-
                 state = self.state[p]
+                p_data_fp32 = _master_weights(p, state)
 
-                if len(state) == 0:
+                if 'step' not in state:
                     state['step'] = 0
                     state['exp_avg'] = torch.zeros_like(p_data_fp32)
                     state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
@@ -130,8 +173,8 @@ class AdamW(Optimizer):
 
                 state['step'] += 1
 
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
 
                 denom = exp_avg_sq.sqrt().add_(group['eps'])
                 bias_correction1 = 1 - beta1 ** state['step']
@@ -144,10 +187,120 @@ class AdamW(Optimizer):
 
                 step_size = scheduled_lr * math.sqrt(bias_correction2) / bias_correction1
                 if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * scheduled_lr, p_data_fp32)
+                    p_data_fp32.add_(p_data_fp32, alpha=-group['weight_decay'] * scheduled_lr)
+
+                p_data_fp32.addcdiv_(exp_avg, denom, value=-step_size)
 
-                p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
+                if p.dtype != torch.float32:
+                    p.data.copy_(p_data_fp32)
 
-                p.data.copy_(p_data_fp32)
+        return loss
 
-        return loss
\ No newline at end of file
+    @torch.no_grad()
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
+        for step, masters, grads, exp_avgs, exp_avg_sqs, denoms, write_back in _foreach_buckets(self, group):
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+            bias_correction1 = 1 - beta1 ** step
+            bias_correction2 = 1 - beta2 ** step
+            if group['warmup'] > step:
+                scheduled_lr = 1e-6 + step * (group['lr'] - 1e-6) / group['warmup']
+            else:
+                scheduled_lr = group['lr']
+            step_size = scheduled_lr * math.sqrt(bias_correction2) / bias_correction1
+
+            if group['weight_decay'] != 0:
+                torch._foreach_mul_(masters, 1 - group['weight_decay'] * scheduled_lr)
+
+            torch._foreach_copy_(denoms, exp_avg_sqs)
+            torch._foreach_sqrt_(denoms)
+            torch._foreach_add_(denoms, group['eps'])
+            torch._foreach_addcdiv_(masters, exp_avgs, denoms, value=-step_size)
+
+            _write_back(write_back)
+
+
+def _radam_step_size(lr, beta1, beta2, step):
+    beta2_t = beta2 ** step
+    N_sma_max = 2 / (1 - beta2) - 1
+    N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+
+    # more conservative since it's an approximated value
+    if N_sma >= 5:
+        step_size = lr * math.sqrt(
+            (1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (
+                        N_sma_max - 2)) / (1 - beta1 ** step)
+    else:
+        step_size = lr / (1 - beta1 ** step)
+    return N_sma, step_size
+
+
+def _foreach_buckets(optimizer, group):
+    """
+      Tensor lists of one param group for the multi-tensor (foreach) updates;
+      advances their step counts. Parameters are bucketed by step count
+      (normally a single bucket), device and dtype, so the scalar part of the
+      update is shared and every foreach kernel sees uniform tensor lists.
+      The lists (and the denominator scratch buffers) are cached and only
+      rebuilt when the set of parameters with gradients changes or a state
+      dict is loaded; per step only the gradient lists are collected.
+      fp32 parameters are their own master weights, so call under no_grad.
+      :returns: generator of (step, masters, grads, exp_avgs, exp_avg_sqs,
+        denoms, write_back) where write_back pairs low precision parameters
+        with their masters
+      """
+    if not hasattr(optimizer, '_foreach_cache'):
+        optimizer._foreach_cache = {}
+    params = [p for p in group['params'] if p.grad is not None]
+    key = tuple(map(id, params))
+    cached = optimizer._foreach_cache.get(id(group))
+    if cached is None or cached[0] != key:
+        cached = optimizer._foreach_cache[id(group)] = (key, _build_buckets(optimizer, params))
+
+    for bucket in cached[1]:
+        bucket['step'] += 1
+        for state in bucket['states']:
+            state['step'] = bucket['step']
+        grads = [p.grad if p.grad.dtype == torch.float32 else p.grad.float() for p in bucket['params']]
+        yield (bucket['step'], bucket['masters'], grads, bucket['exp_avgs'], bucket['exp_avg_sqs'],
+               bucket['denoms'], bucket['write_back'])
+
+
+def _build_buckets(optimizer, params):
+    buckets = {}
+    for p in params:
+        if p.grad.is_sparse:
+            raise RuntimeError('{} does not support sparse gradients'.format(type(optimizer).__name__))
+
+        state = optimizer.state[p]
+        master = p if p.dtype == torch.float32 else _master_weights(p, state)
+        if 'step' not in state:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(master)
+            state['exp_avg_sq'] = torch.zeros_like(master)
+
+        key = (state['step'], master.device, master.dtype)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = dict(step=state['step'], states=[], params=[], masters=[], exp_avgs=[],
+                                         exp_avg_sqs=[], denoms=[], write_back=([], []))
+        bucket['states'].append(state)
+        bucket['params'].append(p)
+        bucket['masters'].append(master)
+        bucket['exp_avgs'].append(state['exp_avg'])
+        bucket['exp_avg_sqs'].append(state['exp_avg_sq'])
+        bucket['denoms'].append(torch.empty_like(master))
+        if master is not p:
+            bucket['write_back'][0].append(p)
+            bucket['write_back'][1].append(master)
+    return list(buckets.values())
+
+
+def _write_back(write_back):
+    params, masters = write_back
+    if params:
+        torch._foreach_copy_(params, masters)
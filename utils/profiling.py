@@ -0,0 +1,89 @@
+import time
+import contextlib
+import torch
+
+
+class StageTimer(object):
+    """Wall-clock time per named stage of a training/validation iteration.
+
+    `stage(name)` times a block; `add(name, seconds)` records time measured
+    elsewhere (e.g. waiting on the DataLoader). `step()` closes the current
+    iteration and returns its per-stage seconds, while epoch totals keep
+    accumulating until `summary()`/`reset()`. CUDA kernels run asynchronously,
+    so with sync=True the device is synchronized at every stage boundary;
+    that makes the split accurate at the cost of some overlap.
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.steps = 0
+        self.current = {}
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.) + seconds
+        self.totals[name] = self.totals.get(name, 0.) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
+
+    def step(self):
+        current, self.current = self.current, {}
+        self.steps += 1
+        return current
+
+    def summary(self):
+        """Per stage: total seconds, mean seconds per step and share of the timed total."""
+        total = sum(self.totals.values())
+        return {name: dict(total=seconds, mean=seconds / max(self.steps, 1), fraction=seconds / total if total > 0 else 0.)
+                for name, seconds in self.totals.items()}
+
+    def format(self):
+        return " ".join("{}={:.1f}%".format(name, 100 * s["fraction"]) for name, s in self.summary().items())
+
+
+class ProfilerWindow(object):
+    """
+      torch.profiler capture of global steps [start, stop), exported as a
+      Chrome trace (chrome://tracing, Perfetto) when the window closes.
+      Call `step(global_step)` at the start of every iteration; it is a no-op
+      outside the window, and when start is None.
+      """
+
+    def __init__(self, start, stop, trace_path):
+        self.start = start
+        self.stop = stop
+        self.trace_path = trace_path
+        self.profiler = None
+
+    def step(self, global_step):
+        if self.start is None:
+            return
+        if self.profiler is None and self.start <= global_step < self.stop:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+        elif self.profiler is not None and global_step >= self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_path)
+            print(" [Profiler] trace of steps [{}, {}) written to {}".format(self.start, self.stop, self.trace_path))
+            self.profiler = None
+            self.start = None
@@ -55,3 +55,19 @@ def optimize_linear(grad, eps, norm=np.inf):
     scaled_perturbation = eps*optimal_perturbation
 
     return scaled_perturbation
+
+
+def load_checkpoint(path, model, map_location="cpu"):
+    """
+      Loads a state_dict saved by main.py into model. The "module." prefix
+      nn.DataParallel adds on save is dropped, so checkpoints load into a bare
+      model on any device.
+      :returns: model
+      """
+    # also reads CheckpointManager files, which carry numpy RNG state
+    state = torch.load(path, map_location=map_location, weights_only=False)
+    if "model" in state and isinstance(state["model"], dict):
+        state = state["model"]
+    state = {(k[len("module."):] if k.startswith("module.") else k): v for k, v in state.items()}
+    model.load_state_dict(state)
+    return model
@@ -7,6 +7,9 @@ Created on Sun Dec 15 23:01:15 2019
 
 import torch
 import torch.nn.functional as F
+import matplotlib
+# render straight to files; no display and no interactive backend
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 import numpy as np
@@ -29,7 +32,10 @@ from torchsummary import summary
 import torchvision 
 import torch.backends.cudnn as cudnn
 from unet import Unet2D
-from utils import optimize_linear
+from utils import optimize_linear, load_checkpoint
+from metrics import ConfusionMatrix
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from losses import DiceLoss, SmoothCrossEntropyLoss
 import numpy as np
 from sklearn.metrics import accuracy_score, precision_score, average_precision_score, jaccard_score
@@ -57,7 +63,7 @@ def loss_plot(train_loss, valid_loss, type_, task):
     plt.grid(True)
     plt.legend(loc= 'upper right')
     plt.savefig('./figure/%s_%s_loss.png'%(type_, task), dpi= 300)
-    plt.show()
+    plt.close()
     
     
 def segmentation_output_image(sample_list, logit, epoch, col_len= 4):
@@ -78,17 +84,40 @@ def segmentation_output_image(sample_list, logit, epoch, col_len= 4):
     for i, ax in enumerate(ax_list):
         ax.matshow(pred[i], cmap= cmap)
         
-    fig.savefig('./figure/sample_%s_epoch.png', dpi= 300)
-    fig.show()
+    fig.savefig('./figure/sample_%s_epoch.png'%(epoch), dpi= 300)
+    plt.close(fig)
 
 
-def draw_plot(real_photo, segmentationmap, predict_map, epoch, model_name, i):
-    from matplotlib import cm
-    viridis = cm.get_cmap('viridis', 256)
-    newcolors = viridis(np.linspace(0, 1, 256))
-    pink = np.array([248/256, 24/256, 148/256, 1])
-    newcolors[:25, :] = pink
-    cmap = ListedColormap(newcolors)
+_label_cmap= None
+
+def label_cmap():
+    # viridis with the background end painted pink, built once per process
+    global _label_cmap
+    if _label_cmap is None:
+        newcolors = plt.get_cmap('viridis', 256)(np.linspace(0, 1, 256))
+        pink = np.array([248/256, 24/256, 148/256, 1])
+        newcolors[:25, :] = pink
+        _label_cmap = ListedColormap(newcolors)
+    return _label_cmap
+
+
+def denormalize(image, mean= (0.485, 0.456, 0.406), std= (0.229, 0.224, 0.225)):
+    
+    '''
+        Normalized (3, H, W) tensor back to an (H, W, 3) uint8 array, so the
+        photo panel reuses the loaded batch instead of re-reading the JPEG.
+        uint8 tensors (datasets built with normalize=False) are only transposed.
+    '''
+    
+    image= image.detach().cpu()
+    if image.dtype != torch.uint8:
+        image= image* torch.tensor(std).view(3, 1, 1)+ torch.tensor(mean).view(3, 1, 1)
+        image= (image.clamp(0, 1)* 255).round().to(torch.uint8)
+    return image.permute(1, 2, 0).numpy()
+
+
+def draw_plot(real_photo, segmentationmap, predict_map, epoch, model_name, i, out_dir= './figure', dpi= 300):
+    cmap = label_cmap()
 
 #    color= ListedColormap([(c, c, c) for c in np.linspace(0, 1, 21)])
     
@@ -118,57 +147,151 @@ def draw_plot(real_photo, segmentationmap, predict_map, epoch, model_name, i):
                     labelleft= False)
     fig.colorbar(im3, ax= ax3)
     
-    fig.savefig('./figure/result_%s_eopch_%s_%s.png'%(epoch, model_name, i), dpi= 300)
-    fig.show()
+    os.makedirs(out_dir, exist_ok= True)
+    fig.savefig(os.path.join(out_dir, 'result_%s_eopch_%s_%s.png'%(epoch, model_name, i)), dpi= dpi)
+    plt.close(fig)
+
+
+def draw_comparison(real_photo, segmentationmap, predict_maps, model_names, i, out_dir= './figure', dpi= 300):
+    
+    '''
+        Side-by-side panel of one sample: photo, true label and the
+        prediction of every model, all on the same color scale.
+    '''
+    
+    cmap = label_cmap()
+    cols= 2+ len(model_names)
+    fig, axes= plt.subplots(1, cols, figsize= (5* cols, 5))
+    
+    axes[0].imshow(np.asarray(real_photo))
+    axes[0].set_title('Real Image')
+    panels= [('True Label', segmentationmap)]+ list(zip(model_names, predict_maps))
+    for ax, (title, label_map) in zip(axes[1:], panels):
+        ax.matshow(np.asarray(label_map).squeeze(), cmap= cmap, vmin= 0, vmax= 20)
+        ax.set_title(title)
+    for ax in axes:
+        ax.tick_params(axis= 'both',
+                       which= 'both',
+                       labelbottom= False,
+                       labeltop= False,
+                       labelleft= False)
+    
+    os.makedirs(out_dir, exist_ok= True)
+    fig.savefig(os.path.join(out_dir, 'comparison_%s.png'%(i)), dpi= dpi)
+    plt.close(fig)
+
+
+def _draw_job(plot, job):
+    plot(**job)
+
+
+def render_plots(jobs, workers= None, plot= draw_plot):
+    
+    '''
+        Renders figures in parallel.
+        Args:
+            jobs: list of dicts of `plot` keyword arguments (numpy arrays,
+                  so they pickle cheaply to the worker processes)
+            workers: process pool size, None for one per CPU, 0 to render in
+                     this process
+            plot: draw_plot or draw_comparison
+    '''
+    
+    if workers == 0:
+        for job in jobs:
+            _draw_job(plot, job)
+        return
+    with ProcessPoolExecutor(max_workers= workers) as pool:
+        # list() re-raises any exception from the workers
+        list(pool.map(partial(_draw_job, plot), jobs))
+
+
+def compare_checkpoints(model_path, model_name, images, target, batch_size= 10, num_classes= 21, device= None):
+    
+    '''
+        Runs every Unet2D checkpoint on the same, already decoded samples.
+        Args:
+            images: (N, 3, H, W) normalized tensor, loaded once by the caller
+            target: (N, H, W) label tensor
+        Returns:
+            predictions: dict model name -> (N, H, W) uint8 label maps
+            ious: dict model name -> per-class IoU (nan for absent classes)
+    '''
+    
+    device= device or images.device
+    _, _, height, width= images.shape
+    # one network, refilled with each checkpoint's weights
+    net= Unet2D((3, height, width), 1, 0.1, num_classes= num_classes).to(device).eval()
+    predictions, ious= {}, {}
+    for path, name in zip(model_path, model_name):
+        load_checkpoint(path, net, map_location= device)
+        confusion= ConfusionMatrix(num_classes)
+        preds= []
+        with torch.no_grad():
+            for start in range(0, len(images), batch_size):
+                pred= net(images[start:start+ batch_size].to(device)).argmax(dim= 1)
+                confusion.update(pred, target[start:start+ batch_size])
+                preds.append(pred.to('cpu', torch.uint8))
+        predictions[name]= torch.cat(preds).numpy()
+        ious[name]= confusion.iou()
+    return predictions, ious
 
 
 if __name__== '__main__':
-    from tqdm import tqdm
+    # e.g. python utils/visualization.py --checkpoints checkpoints/segmentation-*/epoch-0049.pth
+    parser = argparse.ArgumentParser(description="Compares Unet2D checkpoints on a fixed set of validation samples")
+    parser.add_argument("--checkpoints", required=True, nargs="+", type=str, help="Checkpoints saved by main.py")
+    parser.add_argument("--names", default=None, nargs="+", type=str, help="Model names, default the checkpoint directory names")
+    parser.add_argument("--root", default="seg_da/VOCdevkit/VOC2010", type=str, help="VOC root with SegmentationClass and JPEGImages")
+    parser.add_argument("--cache-dir", default=None, type=str, help="Directory of the preprocessed VOC cache")
+    parser.add_argument("--samples", default=20, type=int, help="First samples of the validation split to compare on")
+    parser.add_argument("--batch", default=10, type=int)
+    parser.add_argument("--output", default="./figure", type=str, help="Directory for predictions.npz, iou.csv and the panels")
+    parser.add_argument("--dpi", default=300, type=int)
+    parser.add_argument("--workers", default=None, type=int, help="Rendering processes, default one per CPU, 0 renders in this process")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    args = parser.parse_args()
+
+    model_path = args.checkpoints
+    model_name = args.names or [os.path.basename(os.path.dirname(os.path.abspath(path))) for path in model_path]
+    if len(model_name) != len(model_path) or len(set(model_name)) != len(model_name) :
+        parser.error("--names needs one distinct name per checkpoint")
 
-    label_path = "seg_da/VOCdevkit/VOC2010/SegmentationClass/"
-    image_path = "seg_da/VOCdevkit/VOC2010/JPEGImages"
+    label_path = os.path.join(args.root, "SegmentationClass")
+    image_path = os.path.join(args.root, "JPEGImages")
 
-    trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth = False)
+    # uint8 images: they are normalized for the forward pass and drawn as is
+    trainset = dataset.voc_seg(label_path, image_path, cut_out=False, smooth = False, cache_dir=args.cache_dir, normalize=False)
 
+    # the 70/30 split of main.py
     total_idx = list(range(len(trainset)))
     split_idx = int(len(trainset) * 0.7)
-    trn_idx = total_idx[:split_idx]
     val_idx = total_idx[split_idx:]
 
-    model_path = ['/data1/workspace/geongyu/deep_lr_prj/segmentation-adv-smooth/49-model.pth', 
-                '/data1/workspace/geongyu/deep_lr_prj/segmentation-none-smooth/49-model.pth', 
-                '/data1/workspace/geongyu/deep_lr_prj/segmentation-none-cut-out/49-model.pth',
-                '/data1/workspace/geongyu/deep_lr_prj/segmentation-adv-cut-out/49-model.pth',
-                '/data1/workspace/geongyu/deep_lr_prj/segmentation-adv-none/49-model.pth',
-                '/data1/workspace/geongyu/deep_lr_prj/seg_norm/model_99_future.pth']
-
-    model_name = ["Segmentation_ADV_Smooth", 'Segmentation_Smoothing', 'Segmentation_CutOut', 'Segmentation_ADV_CutOut', 'Segmentation_ADV', "Segmentation Baseline"]
-
-    for model, name in tqdm(zip(model_path, model_name)) :
-        trainloader = torch.utils.data.DataLoader(trainset, batch_size=20, shuffle=False, sampler=SubsetRandomSampler(trn_idx))
-        net = Unet2D((3, 256, 256), 1, 0.1, num_classes=21)
-        st = torch.load(model)
-        net = nn.DataParallel(net).cuda()
-        net.load_state_dict(st)
-
-        data = iter(trainloader).next()
-        model_output = net(data[0])
-        file_name = data[2]
-        target = data[1] 
-
-        for i in range(20) :
-            im = file_name[i]
-            pre = model_output[i].cpu()
-            tar = target[i] 
-
-            real_photo= Image.open(im, 'r')
-            resize = transforms.Resize((256, 256))
-            real_photo= resize(real_photo)
-
-            predict_map= F.softmax(pre, dim= 0)
-            predict_map= predict_map.argmax(dim= 0)
-            #import ipdb; ipdb.set_trace()
-            draw_plot(real_photo, tar, predict_map, epoch= 50, model_name = name, i=str(i))
+    device = torch.device(args.device)
+
+    # a fixed set of validation samples, decoded once and shared by every model
+    sample_idx = val_idx[:args.samples]
+    loader = dataset.build_loader(da.Subset(trainset, sample_idx), len(sample_idx))
+    images, target, file_name, _ = next(iter(loader))
+    x, = dataset.batch_augment()(images.to(device))
+
+    predictions, ious = compare_checkpoints(model_path, model_name, x, target, batch_size=args.batch, device=device)
+
+    os.makedirs(args.output, exist_ok=True)
+    np.savez_compressed(os.path.join(args.output, 'predictions.npz'), file_name=np.array(file_name),
+                        **{name: predictions[name] for name in model_name})
+    with open(os.path.join(args.output, 'iou.csv'), 'w') as f :
+        f.write(','.join(['model'] + ['background'] + dataset.object_categories + ['mIoU']) + '\n')
+        for name in model_name :
+            f.write(','.join([name] + ['%.4f'%(v) for v in ious[name]] + ['%.4f'%(np.nanmean(ious[name]))]) + '\n')
+            print(' [Compare] %s mIoU = [%.3f]'%(name, np.nanmean(ious[name])))
+
+    jobs = [dict(real_photo= denormalize(images[i]), segmentationmap= target[i].numpy(),
+                 predict_maps= [predictions[name][i] for name in model_name], model_names= model_name, i= str(i),
+                 out_dir= args.output, dpi= args.dpi)
+            for i in range(len(sample_idx))]
+    render_plots(jobs, workers= args.workers, plot= draw_comparison)
 
     
 '''       